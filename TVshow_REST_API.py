@@ -1,54 +1,308 @@
-from flask import Flask, request, send_file
-from flask_restx import Resource, Api, reqparse, fields 
+from flask import Flask, Response, request, make_response, current_app
+from contextvars import ContextVar
+from flask_restx import Resource, Api, reqparse, fields, inputs
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-import numpy as np
-import sqlite3
-import pandas as pd
+from sqlalchemy import and_, or_, false, func, select, text, inspect, bindparam, event, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import aliased, validates
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import QueuePool
+from collections import Counter, OrderedDict, deque
+from io import BytesIO, StringIO
+import csv
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import SimpleNamespace
+from datetime import datetime, timedelta, date, timezone
+from werkzeug.http import http_date, quote_etag
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote, urlencode
+import hashlib
+import sqlite3
+import cProfile
+import pstats
+import time
+import base64
+import json
 import os
 import re
 
+try:
+	import orjson
+except ImportError:
+	orjson = None # optional, the standard library encoder is used without it
+try:
+	import fcntl
+except ImportError:
+	fcntl = None # not on Windows, where every process then runs its own TVmaze sync
+
 PORT = 5000 # Deafult for REST
-app = Flask(__name__)
-api = Api(app,
-          default="TVshow",  
+api = Api(default="TVshow",  
           title="TVshow database",  
           description="Use this service to store your favorite TV shows and retrevie useful statistics on them!") 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///z5017350.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
-db = SQLAlchemy(app)
-base = f'http://127.0.0.1:{PORT}/tv-shows/'
+db = SQLAlchemy() # bound to the app by create_app
+
+
+def shows_base():
+	'''The url shows are found under, for building links'''
+
+	return current_app.config['BASE_URL'] + '/tv-shows/'
+
+
+def configure_sqlite(engine, busy_timeout, cache_size):
+	'''Sets up every new sqlite connection of engine for many concurrent readers and writers, across threads and processes'''
+
+	@event.listens_for(engine, 'connect')
+	def set_pragmas(dbapi_connection, connection_record):
+		if not isinstance(dbapi_connection, sqlite3.Connection):
+			return
+		cursor = dbapi_connection.cursor()
+		cursor.execute('PRAGMA journal_mode=WAL') # readers no longer block the writer or each other, kept in the database file
+		cursor.execute(f"PRAGMA busy_timeout={busy_timeout}") # wait for the write lock instead of failing with database is locked
+		cursor.execute('PRAGMA synchronous=NORMAL') # durable with WAL except across power loss, saves an fsync per commit
+		cursor.execute(f"PRAGMA cache_size=-{cache_size}")
+		cursor.close()
+
 
 # ================================== database models ==================================
 class TVshow_table(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
-	tvmaze_id = db.Column(db.Integer, nullable=False)
-	name = db.Column(db.String, nullable=False)
-	last_updated = db.Column(db.DateTime, nullable=False)
-	Type = db.Column(db.String, nullable=True)
-	language = db.Column(db.String, nullable=True)
-	genres = db.Column(db.JSON, nullable=True)
-	status = db.Column(db.String, nullable=True)
-	runtime = db.Column(db.Integer, nullable=True)
-	premiered = db.Column(db.Date, nullable=True)
+	tvmaze_id = db.Column(db.Integer, nullable=False, unique=True, index=True) # checked on every import
+	name = db.Column(db.String, nullable=False, index=True)
+	last_updated = db.Column(db.DateTime, nullable=False, index=True) # backs the total-updated statistic
+	Type = db.Column(db.String, nullable=True, index=True)
+	language = db.Column(db.String, nullable=True, index=True)
+	genres = db.Column(db.JSON, nullable=True) # also kept in TVshow_genre_table for filtering
+	status = db.Column(db.String, nullable=True, index=True)
+	runtime = db.Column(db.Integer, nullable=True, index=True)
+	premiered = db.Column(db.Date, nullable=True, index=True)
 	officialSite = db.Column(db.String, nullable=True)
 	schedule = db.Column(db.JSON, nullable=True)
 	rating = db.Column(db.JSON, nullable=True)
+	rating_average = db.Column(db.Float, nullable=True, index=True) # copy of rating['average'] that SQL can sort on
 	weight = db.Column(db.Integer, nullable=True)
 	network = db.Column(db.JSON , nullable=True)
 	summary = db.Column(db.String, nullable=True)
 
+	@validates('rating')
+	def set_rating_average(self, key, rating):
+		self.rating_average = rating.get('average') if rating else None # keeps the copy in step with every rating change
+		return rating
+
 	def __repr__(self):
 		return f"TVmaze_shows(name = {self.name}, id = {self.id}, tvmaze_id = {self.tvmaze_id})"
 
 
-if not os.path.exists('z5017350.db'):
-	db.create_all() # Initalise database only if it doesn't exist
-else:
-	pass
+class TVshow_statistic_table(db.Model):
+	'''Number of shows per attribute value, attribute 'total' with value '' counts every show
+	and attribute 'version' with value '' counts every write, so it serves as the data version'''
+	attribute = db.Column(db.String, primary_key=True)
+	value = db.Column(db.String, primary_key=True)
+	count = db.Column(db.Integer, nullable=False, default=0)
+
+	def __repr__(self):
+		return f"TVshow_statistics(attribute = {self.attribute}, value = {self.value}, count = {self.count})"
+
+
+class TVshow_import_job_table(db.Model):
+	'''Imports run in the background, one row per job. Finished jobs are kept so their result can still be read'''
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String, nullable=False)
+	query_key = db.Column(db.String, nullable=False) # the name as TVmaze searches it, jobs for the same key are deduplicated
+	status = db.Column(db.String, nullable=False) # queued, running or finished
+	result_status = db.Column(db.Integer, nullable=True) # 201, 400, 404, 409 or 502, as importing without a job would answer
+	result = db.Column(db.JSON, nullable=True)
+	created = db.Column(db.DateTime, nullable=False)
+	claimed = db.Column(db.DateTime, nullable=True) # when a worker started running it, a job running for too long is taken to be dead
+	finished = db.Column(db.DateTime, nullable=True)
+	__table_args__ = (db.Index('ix_import_job_active_query', 'query_key', unique=True, sqlite_where=text("status != 'finished'")),) # one live job per name
+
+	def __repr__(self):
+		return f"TVshow_import_job(id = {self.id}, name = {self.name}, status = {self.status})"
+
+
+class TVshow_genre_table(db.Model):
+	'''One row per genre of a show, so filtering by genre is an index lookup instead of a scan over the genres json'''
+	genre = db.Column(db.String, primary_key=True)
+	show_id = db.Column(db.Integer, db.ForeignKey(TVshow_table.id), primary_key=True, index=True)
+
+	def __repr__(self):
+		return f"TVshow_genres(genre = {self.genre}, show_id = {self.show_id})"
+
+
+statistics_attributes = {'language': 'language', 'status': 'status', 'type': 'Type'} # 'by' parameter -> column, genres handled seperately
+
+search_table = f'{TVshow_table.__tablename__}_search' # FTS5 index over name, summary and genres, its rowid is the show id
+
+def show_snapshot(show):
+	'''Returns the values of a show that the statistics, genre and search tables are built from'''
+
+	return {'name': show.name, 'summary': show.summary, 'language': show.language, 'status': show.status, 
+			'Type': show.Type, 'genres': list(show.genres or [])}
+
+def search_document(snapshot):
+	'''Returns the text a show_snapshot() is indexed under for full text search'''
+
+	return {'name': snapshot['name'], 
+			'summary': re.sub('<[^>]+>', ' ', snapshot['summary'] or ''), # TVmaze summaries are html
+			'genres': ' '.join(snapshot['genres'])}
+
+def statistic_values(snapshot):
+	'''Returns the (attribute, value) pairs a show_snapshot() adds to the statistics table, None adds nothing'''
+
+	if snapshot is None:
+		return []
+	values = [('total', '')]
+	for attribute, column in statistics_attributes.items():
+		value = snapshot[column]
+		if value is not None: # shows without a value aren't counted, but still count towards the total
+			values.append((attribute, value))
+	for genre in set(snapshot['genres']):
+		values.append(('genres', genre))
+	return values
+
+def update_statistics(old_values, new_values, connection=None):
+	'''Applies the difference between two statistic_values() lists to the statistics table, commit is left to the caller'''
+
+	changes = Counter(new_values)
+	changes.subtract(Counter(old_values))
+	changes = [{'attribute': attribute, 'value': value, 'count': count} for (attribute, value), count in changes.items() if count]
+	changes.append({'attribute': 'version', 'value': '', 'count': 1})
+	upsert = sqlite_insert(TVshow_statistic_table)
+	upsert = upsert.on_conflict_do_update(index_elements=['attribute', 'value'],
+										  set_={'count': TVshow_statistic_table.count + upsert.excluded.count})
+	(connection or db.session).execute(upsert, changes)
+
+def update_show_tables(changes, connection=None):
+	'''Brings the tables derived from shows in step with changes, a list of (show id, old snapshot, new snapshot).
+	The old snapshot is None for new shows and the new one is None for deleted shows. Commit is left to the caller'''
+
+	old_values, new_values = [], []
+	removed_genres, added_genres = [], []
+	removed_documents, added_documents = [], []
+	for show_id, old, new in changes:
+		old_values.extend(statistic_values(old))
+		new_values.extend(statistic_values(new))
+		old_genres = set(old['genres']) if old else set()
+		new_genres = set(new['genres']) if new else set()
+		removed_genres.extend({'removed_show_id': show_id, 'removed_genre': genre} for genre in old_genres - new_genres)
+		added_genres.extend({'show_id': show_id, 'genre': genre} for genre in new_genres - old_genres)
+		old_document = search_document(old) if old else None
+		new_document = search_document(new) if new else None
+		if old_document != new_document:
+			if old_document:
+				removed_documents.append({'rowid': show_id})
+			if new_document:
+				added_documents.append(dict(new_document, rowid=show_id))
+
+	update_statistics(old_values, new_values, connection)
+	genres = TVshow_genre_table.__table__
+	if removed_genres:
+		(connection or db.session).execute(genres.delete().where(genres.c.show_id == bindparam('removed_show_id'), 
+																 genres.c.genre == bindparam('removed_genre')), removed_genres)
+	if added_genres:
+		(connection or db.session).execute(genres.insert(), added_genres)
+	if removed_documents:
+		(connection or db.session).execute(text(f'DELETE FROM {search_table} WHERE rowid = :rowid'), removed_documents)
+	if added_documents:
+		(connection or db.session).execute(text(f'INSERT INTO {search_table} (rowid, name, summary, genres) '
+												 'VALUES (:rowid, :name, :summary, :genres)'), added_documents)
+
+def data_version():
+	'''Returns the number of writes made to the shows table, used to tell cached data is stale'''
+
+	return db.session.query(TVshow_statistic_table.count).filter_by(attribute='version', value='').scalar() or 0
+
+def rebuild_statistics(connection):
+	'''Recounts the statistics table from every show, only needed when it is first created'''
+
+	statistics = TVshow_statistic_table.__table__
+	connection.execute(statistics.delete().where(statistics.c.attribute != 'version'))
+	shows = TVshow_table.__table__
+	new_values = []
+	for show in connection.execute(select(shows.c.name, shows.c.summary, shows.c.language, shows.c.status, shows.c.Type, shows.c.genres)):
+		new_values.extend(statistic_values(show_snapshot(show)))
+	update_statistics([], new_values, connection)
+
+
+# ================================== database migrations ==================================
+
+def add_statistics(connection):
+	'''Version 1: statistics table and last_updated index'''
+
+	TVshow_statistic_table.__table__.create(connection, checkfirst=True)
+	for index in TVshow_table.__table__.indexes:
+		if list(index.columns) == [TVshow_table.__table__.c.last_updated]:
+			index.create(connection, checkfirst=True)
+	if connection.execute(select(TVshow_statistic_table.__table__.c.count).limit(1)).first() is None:
+		rebuild_statistics(connection)
+
+def add_rating_average_and_indexes(connection):
+	'''Version 2: numeric rating_average column, unique tvmaze_id index and an index behind every order_by attribute'''
+
+	table = TVshow_table.__tablename__
+	if 'rating_average' not in [column['name'] for column in inspect(connection).get_columns(table)]:
+		connection.execute(text(f'ALTER TABLE {table} ADD COLUMN rating_average FLOAT'))
+		connection.execute(text(f"UPDATE {table} SET rating_average = json_extract(rating, '$.average')"))
+	for index in TVshow_table.__table__.indexes:
+		index.create(connection, checkfirst=True)
+
+def add_genres_and_filter_indexes(connection):
+	'''Version 3: genre table filled from the genres json, indexes behind the language, status and type filters'''
+
+	genres = TVshow_genre_table.__table__
+	if not inspect(connection).has_table(genres.name):
+		genres.create(connection)
+		connection.execute(text(f"INSERT OR IGNORE INTO {genres.name} (genre, show_id) "
+								f"SELECT json_each.value, {TVshow_table.__tablename__}.id FROM {TVshow_table.__tablename__}, json_each(genres)"))
+	for index in TVshow_table.__table__.indexes:
+		index.create(connection, checkfirst=True)
+
+def create_search_table(connection):
+	connection.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {search_table} USING fts5(name, summary, genres, tokenize = 'porter unicode61')"))
+
+def add_search(connection):
+	'''Version 4: full text search table, indexed from every stored show'''
+
+	create_search_table(connection)
+	connection.execute(text(f'DELETE FROM {search_table}'))
+	shows = TVshow_table.__table__
+	documents = [dict(search_document(show_snapshot(show)), rowid=show.id) for show in 
+				 connection.execute(select(shows.c.id, shows.c.name, shows.c.summary, shows.c.language, shows.c.status, shows.c.Type, shows.c.genres))]
+	if documents:
+		connection.execute(text(f'INSERT INTO {search_table} (rowid, name, summary, genres) VALUES (:rowid, :name, :summary, :genres)'), documents)
+
+def add_import_jobs(connection):
+	'''Version 5: import job table'''
+
+	TVshow_import_job_table.__table__.create(connection, checkfirst=True)
+
+def add_import_job_claims(connection):
+	'''Version 6: claimed time of running import jobs, so jobs left running by a dead process can be found'''
+
+	table = TVshow_import_job_table.__tablename__
+	if 'claimed' not in [column['name'] for column in inspect(connection).get_columns(table)]:
+		connection.execute(text(f'ALTER TABLE {table} ADD COLUMN claimed DATETIME'))
+		connection.execute(text(f"UPDATE {table} SET status = 'queued' WHERE status = 'running'")) # claimed before claims were recorded, run them again
+
+migrations = [add_statistics, add_rating_average_and_indexes, add_genres_and_filter_indexes, add_search, add_import_jobs, add_import_job_claims] # migrations[n] upgrades a version n database to n + 1
+SCHEMA_VERSION = len(migrations)
+
+def migrate_database():
+	'''Creates the database, or upgrades an existing one in place. Its version is kept in sqlite's user_version pragma'''
+
+	with db.engine.begin() as connection:
+		version = connection.execute(text('PRAGMA user_version')).scalar()
+		if not inspect(connection).has_table(TVshow_table.__tablename__):
+			db.Model.metadata.create_all(connection) # new database, already at the latest version
+			create_search_table(connection)
+			version = SCHEMA_VERSION
+		for migration in migrations[version:]:
+			migration(connection)
+		connection.execute(text(f'PRAGMA user_version = {SCHEMA_VERSION}'))
 
 # ================================== api model ==================================
 
@@ -97,45 +351,74 @@ TVshow_model = api.model('TVshow_table', {
 
 # ================================== Helper functions ==================================
 
-def find_row(self_id, final_id, direction):
-	'''Given an ID, returns '''
+def neighbour_columns():
+	'''Returns (previous id, next id) subqueries correlated to TVshow_table.id, for selecting alongside a show'''
 
-	check_id = self_id
-	while True:
-		check_id = check_id + direction # direction can be 1 or -1 
-		if check_id < 0:
-			return None # This means there's no previous
-		elif check_id > final_id:
-			return None # This means there's no next
-		if TVshow_table.query.filter_by(id=check_id).first():
-			return check_id # This means id was in db, the first() method returns None if not in db
+	other = aliased(TVshow_table)
+	previous_id = db.session.query(func.max(other.id)).filter(other.id < TVshow_table.id).scalar_subquery() # rowid range lookups
+	next_id = db.session.query(func.min(other.id)).filter(other.id > TVshow_table.id).scalar_subquery()
+	return previous_id, next_id
 
-def generate_href(self_id):
-	'''Generates hrefs'''
+def find_neighbours(ids):
+	'''Given IDs, returns {id: (previous id, next id)} using a single query, gaps left by deletes cost nothing'''
 
-	final_id = TVshow_table.query.all()[-1].id  # Get final ID
-	neighbours = {'previous': -1, 'next': 1} # As of python 3.6, dictionary objects retain their order
-	links = {'self' : {'href' : base + str(self_id)}}
+	rows = db.session.query(TVshow_table.id, *neighbour_columns()).filter(TVshow_table.id.in_(ids)).all()
+	return {row[0] : (row[1], row[2]) for row in rows} # previous/next are None at either end of the table
 
-	for neighbour in neighbours:
-		neighbours[neighbour] = find_row(self_id, final_id, direction=neighbours[neighbour])
-		if neighbours[neighbour]:
-			links[neighbour] = {'href' : base + str(neighbours[neighbour])}
+def generate_href(self_id, neighbours=None):
+	'''Generates hrefs, neighbours can be passed in from a batched find_neighbours call'''
+
+	if neighbours is None:
+		neighbours = find_neighbours([self_id]).get(self_id, (None, None))
+	links = {'self' : {'href' : shows_base() + str(self_id)}}
+
+	for neighbour, neighbour_id in zip(['previous', 'next'], neighbours):
+		if neighbour_id is not None:
+			links[neighbour] = {'href' : shows_base() + str(neighbour_id)}
 
 	return links
 
-def generate_response(model, update=None):
-	'''Generates response json'''
+def make_etag(*parts):
+	'''Strong ETag over everything a response is built from'''
+
+	return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
 
-	if update:
-		last_update = datetime.today().replace(microsecond=0)
+def validator_headers(etag, last_modified=None):
+	'''ETag and Last-Modified headers, clients are asked to revalidate rather than reuse blindly'''
+
+	headers = {'ETag': quote_etag(etag), 'Cache-Control': 'no-cache'}
+	if last_modified:
+		headers['Last-Modified'] = http_date(last_modified.astimezone(timezone.utc)) # last_updated is stored in local time
+	return headers
+
+def not_modified(etag, last_modified=None):
+	'''Returns a 304 response if the request's If-None-Match or If-Modified-Since still holds, otherwise None'''
+
+	if request.if_none_match: # takes precedence over If-Modified-Since
+		unchanged = request.if_none_match.contains(etag)
+	elif request.if_modified_since and last_modified:
+		if_modified_since = request.if_modified_since
+		if if_modified_since.tzinfo is None:
+			if_modified_since = if_modified_since.replace(tzinfo=timezone.utc) # older werkzeug parses to naive utc
+		unchanged = last_modified.astimezone(timezone.utc).replace(microsecond=0) <= if_modified_since
 	else:
-		last_update = model.last_updated
+		unchanged = False
+	if unchanged:
+		return make_response('', 304, validator_headers(etag, last_modified))
+	return None
+
+def next_update_time(last_updated):
+	'''Returns the time to record for a write, always later than last_updated so a show's ETag and Last-Modified change'''
+
+	return max(datetime.today().replace(microsecond=0), last_updated + timedelta(seconds=1))
+
+def generate_response(model):
+	'''Generates response json'''
 
 	return {'id': model.id,
-			'last-update': str(last_update),
+			'last-update': str(model.last_updated),
 			'tvmaze-id': model.tvmaze_id,
-			'_links': {'self' : {'href' : base + str(model.id)}}} # Response 
+			'_links': {'self' : {'href' : shows_base() + str(model.id)}}} # Response 
 
 
 def parse_order_by_param(value):
@@ -167,15 +450,934 @@ def parse_filter_by_param(value):
 	return attributes
 
 
+def parse_list_param(value):
+	return [item.strip() for item in value.split(',') if item.strip()] # remove any leading or trailing white spaces
+
+
+def order_by_column(attribute):
+	'''Maps an order_by attribute onto its table column'''
+
+	if attribute == 'rating-average':
+		attribute = 'rating_average'
+	return getattr(TVshow_table, attribute)
+
+
+def keyset_order(order_by):
+	'''Returns the order_by list with id appended as a tie-breaker, so every row has a unique sort key'''
+
+	if '+id' in order_by or '-id' in order_by:
+		return order_by
+	return order_by + ['+id']
+
+
+def encode_cursor(order_by, row, direction):
+	'''Encodes the sort key of row into an opaque cursor, direction is either next or previous'''
+
+	values = []
+	for order_by_attribute in keyset_order(order_by):
+		value = getattr(row, order_by_column(order_by_attribute[1:]).key)
+		values.append(value.isoformat() if isinstance(value, date) else value) # dates aren't json serialisable
+	cursor = json.dumps({'o': order_by, 'k': values, 'd': direction}, separators=(',', ':'))
+	return base64.urlsafe_b64encode(cursor.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, order_by):
+	'''Decodes a cursor made by encode_cursor, returns (direction, sort key values)'''
+
+	try:
+		cursor = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+		order_by_attributes, values, direction = cursor['o'], cursor['k'], cursor['d']
+	except Exception:
+		raise Exception("Cursor is invalid, use the cursors returned in _links.")
+	if order_by_attributes != order_by or direction not in ['next', 'previous'] or len(values) != len(keyset_order(order_by)):
+		raise Exception("Cursor does not match the order_by parameter of this request.")
+	for i, order_by_attribute in enumerate(keyset_order(order_by)):
+		if order_by_attribute[1:] == 'premiered' and values[i] is not None:
+			values[i] = date.fromisoformat(values[i]) # Date column only binds date objects
+	return direction, values
+
+
+def keyset_filter(order_by, values, reverse=False):
+	'''Builds the WHERE clause selecting rows strictly after the sort key values, or before them if reverse'''
+
+	def equals(column, value):
+		return column.is_(None) if value is None else column == value
+
+	def after(column, ascending, value):
+		# SQLite sorts NULL before every other value
+		if ascending:
+			return column.isnot(None) if value is None else column > value
+		return false() if value is None else or_(column < value, column.is_(None))
+
+	keys = [(order_by_column(attribute[1:]), (attribute[0] == '+') != reverse) for attribute in keyset_order(order_by)]
+	clauses = []
+	for i, (column, ascending) in enumerate(keys):
+		preceding = [equals(keys[j][0], values[j]) for j in range(i)]
+		clauses.append(and_(*preceding, after(column, ascending, values[i])))
+	return or_(*clauses)
+
+
+def json_body(payload):
+	'''Encodes payload with the fastest json encoder available'''
+
+	return orjson.dumps(payload) if orjson else json.dumps(payload, separators=(',', ':')).encode()
+
+def json_response(payload, status=200):
+	return make_response(json_body(payload), status, {'Content-Type': 'application/json'})
+
+
+class Row_store:
+	'''Row cache entries kept in a small sqlite file of their own, so every worker process on the host shares them and their invalidations.
+	Entries are dropped in the order they were stored once there are more than size, reads don't refresh them so hits stay read only.
+	Opening the store empties it, as the database may have changed while no worker was running'''
+
+	def __init__(self, path, size):
+		self.path = path
+		self.size = size
+		self.local = threading.local() # sqlite connections can't be shared between threads
+		self.puts = 0
+		with self.connection() as connection:
+			connection.execute('CREATE TABLE IF NOT EXISTS rows (id INTEGER PRIMARY KEY, body BLOB, etag TEXT, last_updated TEXT, stored REAL)')
+			connection.execute('CREATE INDEX IF NOT EXISTS rows_stored ON rows (stored)')
+			connection.execute('CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER)')
+			connection.execute('INSERT OR IGNORE INTO generation VALUES (0, 0)')
+		self.clear()
+
+	def connection(self):
+		if not hasattr(self.local, 'connection'):
+			connection = sqlite3.connect(self.path, timeout=10)
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=OFF') # a cache lost in a crash is only a cold cache
+			self.local.connection = connection
+		return self.local.connection
+
+	def generation(self):
+		return self.connection().execute('SELECT value FROM generation').fetchone()[0]
+
+	def get(self, id):
+		entry = self.connection().execute('SELECT body, etag, last_updated FROM rows WHERE id = ?', (id,)).fetchone()
+		return None if entry is None else (entry[0], entry[1], datetime.fromisoformat(entry[2]))
+
+	def put(self, id, entry, generation):
+		body, etag, last_updated = entry
+		with self.connection() as connection:
+			connection.execute('INSERT OR REPLACE INTO rows SELECT ?, ?, ?, ?, ? WHERE (SELECT value FROM generation) = ?',
+							   (id, body, etag, last_updated.isoformat(), time.time(), generation))
+		self.puts += 1
+		if self.puts % 100 == 0: # trim now and then, not on every put
+			with self.connection() as connection:
+				connection.execute('DELETE FROM rows WHERE stored <= (SELECT stored FROM rows ORDER BY stored DESC LIMIT 1 OFFSET ?)', (self.size,))
+
+	def invalidate(self, ids):
+		with self.connection() as connection:
+			connection.executemany('DELETE FROM rows WHERE id = ?', [(id,) for id in ids])
+			connection.execute('UPDATE generation SET value = value + 1')
+
+	def clear(self):
+		with self.connection() as connection:
+			connection.execute('DELETE FROM rows')
+			connection.execute('UPDATE generation SET value = value + 1') # puts of shows read before now are dropped
+
+
+class Row_cache:
+	'''Read through cache of serialized GET /tv-shows/<id> responses as (body, etag, last_updated), keyed by id.
+	Kept in a Row_store every worker process on the database shares, or in an LRU in this process when no other process can
+	see the database (sqlite in memory), as a process can't hear of another's writes otherwise. Every invalidation bumps a generation,
+	and puts made with a generation read before it are dropped, so a request that read a show just before it was written
+	can't cache the old version'''
+
+	def __init__(self, size, store=None):
+		self.size = size
+		self.store = store
+		self.entries = OrderedDict()
+		self.current_generation = 0
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		self.lock = threading.Lock()
+
+	def generation(self):
+		return self.store.generation() if self.store else self.current_generation
+
+	def get(self, id):
+		if self.size <= 0:
+			return None
+		if self.store:
+			entry = self.store.get(id)
+		else:
+			with self.lock:
+				entry = self.entries.get(id)
+				if entry is not None:
+					self.entries.move_to_end(id) # most recently used
+		with self.lock:
+			if entry is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+		return entry
+
+	def put(self, id, entry, generation):
+		if self.size <= 0:
+			return
+		if self.store:
+			return self.store.put(id, entry, generation)
+		with self.lock:
+			if generation != self.current_generation:
+				return # the show may have changed since it was read
+			self.entries[id] = entry
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+
+	def invalidate(self, ids):
+		ids = list(ids)
+		if self.store:
+			self.store.invalidate(ids)
+		with self.lock:
+			for id in ids:
+				self.entries.pop(id, None)
+			self.current_generation += 1
+			self.invalidations += len(ids)
+
+	def exposition(self):
+		'''Returns the hit, miss and invalidation counters as lines of Prometheus' text format'''
+
+		lines = []
+		for name, description, value in [('hits', "Shows served from the row cache", self.hits),
+										 ('misses', "Shows read from the database as they were not cached", self.misses),
+										 ('invalidations', "Cached shows dropped because they were written", self.invalidations)]:
+			lines += [f'# HELP tvshow_row_cache_{name}_total {description}', f'# TYPE tvshow_row_cache_{name}_total counter',
+					  f'tvshow_row_cache_{name}_total {value}']
+		return lines
+
+
+def with_neighbours(ids):
+	'''Returns ids together with the shows next to them, as those link to them'''
+
+	affected = set(ids)
+	for chunk in chunks(list(affected), 500): # stays under sqlite's bound parameter limit
+		for neighbours in find_neighbours(chunk).values():
+			affected.update(neighbour_id for neighbour_id in neighbours if neighbour_id is not None)
+	return affected
+
+def invalidate_rows(ids):
+	'''Drops shows from the row cache, call after the write is committed'''
+
+	current_app.extensions['row_cache'].invalidate(ids)
+
+
+class Chart_cache:
+	'''Thread safe LRU of rendered statistics images, keyed by (attribute, data version)'''
+
+	def __init__(self, size):
+		self.size = size
+		self.charts = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			png = self.charts.get(key)
+			if png is not None:
+				self.charts.move_to_end(key) # most recently used
+			return png
+
+	def put(self, key, png):
+		with self.lock:
+			for stale_key in [cached_key for cached_key in self.charts if cached_key[1:] != key[1:]]:
+				del self.charts[stale_key] # rendered from data that has since changed
+			self.charts[key] = png
+			while len(self.charts) > self.size:
+				self.charts.popitem(last=False)
+
+
+def render_chart(attribute, values, percentages, counts, total, recently_updated_shows):
+	'''Renders the statistics bar chart to PNG bytes, uses a figure local Agg canvas so requests can render concurrently'''
+
+	from matplotlib.figure import Figure # the plotting stack takes hundreds of ms to import, only pay for it once a chart is drawn
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	import numpy as np
+
+	fig = Figure(figsize=(10, 7))
+	FigureCanvasAgg(fig)
+	ax = fig.subplots(nrows=1, ncols=1)
+	width = 0.4
+	x =  np.arange(len(percentages))
+	rects = ax.bar(x, percentages, width , label=f'{attribute} (with number of occurrences)', zorder=2)
+	ax.plot([], label=f"Total number of shows: {total}", linestyle='')
+	ax.plot([], label=f"Recently updated shows: {recently_updated_shows}", linestyle='')
+
+	ax.legend(fontsize='large', loc='best')
+	ax.set_ylabel('Percentage %', fontsize='large')
+	ax.set_xlabel(attribute, fontsize='large')
+	ax.set_ylim([0, 100])
+	ax.set_title(f'Percentage of shows in the database against {attribute}')
+	ax.set_xticks(x)
+	ax.set_xticklabels(values)
+	ax.set_facecolor('#EAEAF2') # seaborn look, without touching the global style
+	ax.grid(axis='y', color='w', zorder=1)
+	fig.autofmt_xdate(rotation=45)
+
+	ax.bar_label(rects, labels=counts , padding=3)
+	fig.tight_layout()
+	image = BytesIO()
+	fig.savefig(image, format='png', facecolor='w', bbox_inches='tight')
+	return image.getvalue()
+
+
+# ================================== request metrics ==================================
+
+class Histogram:
+	'''Thread safe Prometheus histogram, keeps cumulative bucket counts for every combination of label values'''
+
+	def __init__(self, name, description, labels, buckets):
+		self.name = name
+		self.description = description
+		self.labels = labels
+		self.buckets = buckets
+		self.series = {} # label values: bucket counts, then the count and sum of observations
+		self.lock = threading.Lock()
+
+	def observe(self, label_values, value):
+		with self.lock:
+			series = self.series.setdefault(label_values, [0] * (len(self.buckets) + 1) + [0.0])
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					series[i] += 1
+			series[-2] += 1
+			series[-1] += value
+
+	def exposition(self):
+		'''Returns the histogram as lines of Prometheus' text format'''
+
+		with self.lock:
+			series = sorted((label_values, list(values)) for label_values, values in self.series.items())
+		lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+		for label_values, values in series:
+			labels = ','.join(f'{label}="{escape_label(value)}"' for label, value in zip(self.labels, label_values))
+			for bound, count in zip(self.buckets, values):
+				lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+			lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {values[-2]}')
+			lines.append(f'{self.name}_count{{{labels}}} {values[-2]}')
+			lines.append(f'{self.name}_sum{{{labels}}} {values[-1]}')
+		return lines
+
+
+def escape_label(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+seconds_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+request_histograms = {
+	'duration': Histogram('tvshow_request_duration_seconds', "Wall time of each request", ('method', 'route', 'status'), seconds_buckets),
+	'sql_statements': Histogram('tvshow_request_sql_statements', "SQL statements run by each request", ('method', 'route'),
+								(0, 1, 2, 3, 5, 10, 25, 50, 100, 250, 1000)),
+	'sql_seconds': Histogram('tvshow_request_sql_seconds', "Time each request spent running SQL", ('method', 'route'), seconds_buckets),
+	'tvmaze_seconds': Histogram('tvshow_request_tvmaze_seconds', "Time each request spent waiting on TVmaze, summed over concurrent calls",
+								('method', 'route'), seconds_buckets),
+}
+
+
+class Request_metrics:
+	'''What one request spent its time on, filled in by the SQL events and the TVmaze client while it runs'''
+
+	def __init__(self, trace):
+		self.started = time.perf_counter()
+		self.sql_statements = 0
+		self.sql_seconds = 0.0
+		self.tvmaze_calls = 0
+		self.tvmaze_seconds = 0.0
+		self.statements = [] if trace else None # (seconds, sql) of every statement, only kept in slow request mode
+		self.profiler = None
+		self.lock = threading.Lock() # TVmaze calls are made from worker threads
+
+	def add_statement(self, seconds, statement):
+		with self.lock:
+			self.sql_statements += 1
+			self.sql_seconds += seconds
+			if self.statements is not None:
+				self.statements.append((seconds, statement))
+
+	def add_tvmaze_call(self, seconds):
+		with self.lock:
+			self.tvmaze_calls += 1
+			self.tvmaze_seconds += seconds
+
+request_metrics = ContextVar('request_metrics', default=None) # the metrics of the request being handled, None outside requests
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(connection, cursor, statement, parameters, context, executemany):
+	if request_metrics.get() is not None:
+		connection.info.setdefault('statement_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(connection, cursor, statement, parameters, context, executemany):
+	metrics = request_metrics.get()
+	if metrics is not None and connection.info.get('statement_started'):
+		metrics.add_statement(time.perf_counter() - connection.info['statement_started'].pop(), statement)
+
+
+def start_request_metrics():
+	metrics = Request_metrics(trace=current_app.config['SLOW_REQUEST_SECONDS'] is not None)
+	if current_app.config['SLOW_REQUEST_SECONDS'] is not None and current_app.config['SLOW_REQUEST_PROFILE']:
+		metrics.profiler = cProfile.Profile()
+		try:
+			metrics.profiler.enable()
+		except ValueError:
+			metrics.profiler = None # another profiler is running, the SQL trace is still kept
+	request_metrics.set(metrics)
+
+def record_request_metrics(response):
+	metrics = request_metrics.get()
+	if metrics is None:
+		return response
+	if metrics.profiler is not None:
+		metrics.profiler.disable()
+	duration = time.perf_counter() - metrics.started
+	route = request.url_rule.rule if request.url_rule else 'unmatched' # the rule, not the path, keeps the label count bounded
+	request_histograms['duration'].observe((request.method, route, str(response.status_code)), duration)
+	request_histograms['sql_statements'].observe((request.method, route), metrics.sql_statements)
+	request_histograms['sql_seconds'].observe((request.method, route), metrics.sql_seconds)
+	request_histograms['tvmaze_seconds'].observe((request.method, route), metrics.tvmaze_seconds)
+	if current_app.config['SLOW_REQUEST_SECONDS'] is not None and duration >= current_app.config['SLOW_REQUEST_SECONDS']:
+		dump_slow_request(metrics, duration, response.status_code)
+	return response
+
+def clear_request_metrics(error=None):
+	request_metrics.set(None)
+
+
+def dump_slow_request(metrics, duration, status):
+	'''Writes the SQL trace, and the profile when one was taken, of a slow request to SLOW_REQUEST_DIR'''
+
+	os.makedirs(current_app.config['SLOW_REQUEST_DIR'], exist_ok=True)
+	name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{request.method}-{re.sub('[^a-zA-Z0-9]+', '_', request.path).strip('_')}"
+	path = os.path.join(current_app.config['SLOW_REQUEST_DIR'], name)
+	with open(path + '.txt', 'w') as trace:
+		trace.write(f"{request.method} {request.full_path.rstrip('?')} -> {status} in {duration * 1000:.1f}ms\n"
+					f"{metrics.sql_statements} SQL statements in {metrics.sql_seconds * 1000:.1f}ms, "
+					f"{metrics.tvmaze_calls} TVmaze calls in {metrics.tvmaze_seconds * 1000:.1f}ms\n\n")
+		for seconds, statement in metrics.statements:
+			trace.write(f"{seconds * 1000:8.2f}ms  {' '.join(statement.split())}\n")
+		if metrics.profiler is not None:
+			profile = StringIO()
+			pstats.Stats(metrics.profiler, stream=profile).sort_stats('cumulative').print_stats(40)
+			trace.write('\n' + profile.getvalue())
+			metrics.profiler.dump_stats(path + '.prof') # for snakeviz and friends
+	current_app.logger.warning(f"Slow request {request.method} {request.full_path.rstrip('?')} took {duration * 1000:.1f}ms, trace written to {path}.txt")
+
+
+# ================================== TVmaze client ==================================
+
+class Rate_limiter:
+	'''Thread safe sliding window limiter, allows at most calls in any period seconds, bursts included.
+	Per process, like the rest of the TVmaze client'''
+
+	def __init__(self, calls, period):
+		self.period = period
+		self.recent = deque(maxlen=calls) # monotonic times of the latest calls, oldest first
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		'''Blocks until a call is allowed'''
+
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				if len(self.recent) < self.recent.maxlen or self.recent[0] + self.period <= now:
+					self.recent.append(now) # drops the oldest once full
+					return
+				wait = self.recent[0] + self.period - now
+			time.sleep(wait) # sleep outside the lock so other threads can check the window
+
+
+class Response_cache:
+	'''On disk cache of TVmaze responses, one json file per request, entries expire after ttl seconds.
+	Expired files are removed when read, and the whole directory is swept every sweep_every writes'''
+
+	sweep_every = 100
+
+	def __init__(self, directory, ttl):
+		self.directory = directory
+		self.ttl = ttl
+		self.writes = 0
+		os.makedirs(directory, exist_ok=True)
+
+	def path(self, key):
+		return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+	def get(self, key):
+		path = self.path(key)
+		try:
+			if os.path.getmtime(path) + self.ttl < time.time():
+				os.remove(path) # expired
+				return None
+			with open(path) as cached:
+				return json.load(cached)
+		except (OSError, ValueError):
+			return None # not cached, or cached by a writer that crashed
+
+	def put(self, key, value):
+		path = self.path(key)
+		temporary = f'{path}.{os.getpid()}.{threading.get_ident()}'
+		with open(temporary, 'w') as cached:
+			json.dump(value, cached)
+		os.replace(temporary, path) # atomic, readers never see half written files
+		self.writes += 1 # not locked, an occasional missed or extra sweep does no harm
+		if self.writes % self.sweep_every == 0:
+			self.sweep()
+
+	def sweep(self):
+		'''Removes every expired entry, including those never read again'''
+
+		expired = time.time() - self.ttl
+		for entry in os.scandir(self.directory):
+			try:
+				if entry.name.endswith('.json') and entry.stat().st_mtime < expired:
+					os.remove(entry.path)
+			except OSError:
+				pass # removed by another process meanwhile
+
+
+class TVmaze_client:
+	'''Access to the TVmaze API through a pooled session with timeouts and retries,
+	a rate limiter shared by every thread and an on disk response cache. All TVmaze calls go through here.'''
+
+	retry_statuses = {429, 500, 502, 503, 504}
+
+	def __init__(self, base_url, timeout, retries, rate_limit, cache_directory, cache_ttl, pool_size):
+		self.base_url = base_url.rstrip('/')
+		self.timeout = timeout
+		self.retries = retries
+		self.limiter = Rate_limiter(*rate_limit)
+		self.cache = Response_cache(cache_directory, cache_ttl)
+		self.session = requests.Session() # keeps connections alive between calls
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size) # retried in get, so every attempt goes through the limiter
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+	def get(self, path, params=None, cache=True):
+		'''Returns the json payload of GET path, from the cache when possible'''
+
+		key = path + '?' + urlencode(sorted((params or {}).items()))
+		if cache:
+			payload = self.cache.get(key)
+			if payload is not None:
+				return payload
+		for attempt in range(self.retries + 1):
+			self.limiter.acquire() # retries count against TVmaze's limit too
+			started = time.perf_counter()
+			try:
+				response = self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+			except (requests.ConnectionError, requests.Timeout):
+				if attempt == self.retries:
+					raise
+				response = None
+			finally:
+				metrics = request_metrics.get()
+				if metrics is not None:
+					metrics.add_tvmaze_call(time.perf_counter() - started)
+			if response is not None and (response.status_code not in self.retry_statuses or attempt == self.retries):
+				break
+			time.sleep(self.retry_delay(response, attempt))
+		response.raise_for_status()
+		payload = response.json()
+		if cache:
+			self.cache.put(key, payload)
+		return payload
+
+	def retry_delay(self, response, attempt):
+		'''Seconds to wait before retrying, the Retry-After of a 429 or else an exponential backoff'''
+
+		retry_after = response.headers.get('Retry-After') if response is not None else None
+		if retry_after and retry_after.isdigit():
+			return int(retry_after)
+		return 0.5 * 2 ** attempt
+
+	def search_shows(self, show_query):
+		'''Returns the search results for show_query, similar queries (case, dashes, spacing) share a cache entry'''
+
+		show_query = ' '.join(show_query.lower().replace('-', ' ').split())
+		return self.get('/search/shows', {'q': show_query})
+
+	def get_show(self, tvmaze_id, cache=True):
+		'''Returns the show json for tvmaze_id'''
+
+		return self.get(f'/shows/{tvmaze_id}', cache=cache)
+
+	def show_updates(self, since='day'):
+		'''Returns {tvmaze id: unix time last updated} for every show updated within since, which is day, week or month'''
+
+		return self.get('/updates/shows', {'since': since}, cache=False)
+
+def tvmaze_client():
+	'''The TVmaze client of the current app. Needs an app context, so code handing work to other threads fetches it first'''
+
+	return current_app.extensions['tvmaze']
+
+
+# ================================== TVmaze sync ==================================
+
+def chunks(items, size):
+	'''Splits items into lists of at most size'''
+
+	return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class TVmaze_sync(threading.Thread):
+	'''Background worker that regularly refreshes the stored shows TVmaze has updated since we last wrote them.
+	It runs on its own thread with its own app context and database session, so requests are never blocked by it'''
+
+	def __init__(self, app, interval, workers, batch_size):
+		super().__init__(name='tvmaze-sync', daemon=True)
+		self.app = app
+		self.interval = interval # seconds between syncs
+		self.workers = workers # concurrent TVmaze show lookups, still subject to the client's rate limit
+		self.batch_size = batch_size # shows written back per transaction
+		self.stopped = threading.Event()
+
+	def run(self):
+		while not self.stopped.is_set():
+			with self.app.app_context():
+				try:
+					self.sync()
+				except Exception:
+					self.app.logger.exception("TVmaze sync failed, retrying next interval")
+			self.stopped.wait(self.interval)
+
+	def stop(self):
+		self.stopped.set()
+
+	def sync(self):
+		'''Runs one sync, returns the number of shows refreshed'''
+
+		tvmaze = tvmaze_client()
+		since = 'day' if self.interval <= 24 * 3600 else 'week' if self.interval <= 7 * 24 * 3600 else 'month'
+		updates = {int(tvmaze_id): datetime.fromtimestamp(updated) for tvmaze_id, updated in tvmaze.show_updates(since).items()}
+
+		stale = []
+		for tvmaze_ids in chunks(list(updates), 500): # stays under sqlite's bound parameter limit
+			for tvmaze_id, last_updated in db.session.query(TVshow_table.tvmaze_id, TVshow_table.last_updated)\
+													.filter(TVshow_table.tvmaze_id.in_(tvmaze_ids)):
+				if updates[tvmaze_id] > last_updated:
+					stale.append(tvmaze_id)
+		db.session.rollback() # don't hold a read transaction open while fetching
+
+		def fetch(tvmaze_id):
+			try:
+				return tvmaze.get_show(tvmaze_id, cache=False)
+			except (requests.RequestException, ValueError):
+				return None # picked up again next sync, as its last_updated stays behind
+
+		refreshed = 0
+		with ThreadPoolExecutor(max_workers=self.workers) as pool:
+			for tvmaze_ids in chunks(stale, self.batch_size):
+				shows = [show for show in pool.map(fetch, tvmaze_ids) if show]
+				refreshed += self.write_back(shows)
+		return refreshed
+
+	def write_back(self, shows):
+		'''Writes refreshed TVmaze shows over their stored rows in one transaction'''
+
+		rows = {row.tvmaze_id : row for row in TVshow_table.query.filter(TVshow_table.tvmaze_id.in_([show['id'] for show in shows]))}
+		changes = []
+		for show in shows:
+			row = rows.get(show['id'])
+			if row is None:
+				continue # deleted while it was being fetched
+			old_snapshot = show_snapshot(row)
+			for column, value in show_columns(show).items():
+				setattr(row, column, value)
+			row.last_updated = next_update_time(row.last_updated)
+			changes.append((row.id, old_snapshot, show_snapshot(row)))
+		if changes:
+			update_show_tables(changes)
+		db.session.commit()
+		invalidate_rows([show_id for show_id, _, _ in changes])
+		return len(changes)
+
+
+def sync_lock(path):
+	'''Takes an exclusive lock on path without waiting. Returns the open lock file, held until it is closed or the process exits,
+	or None when another process holds the lock'''
+
+	lock = open(path, 'a')
+	try:
+		fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		lock.close()
+		return None
+	return lock
+
+def start_sync(app):
+	'''Starts the background TVmaze sync for app, returns the running worker.
+	With several worker processes on one database only the first to take SYNC_LOCK_FILE syncs, the others return None'''
+
+	lock = None
+	if app.config['SYNC_LOCK_FILE'] and fcntl:
+		lock = sync_lock(app.config['SYNC_LOCK_FILE'])
+		if lock is None:
+			return None
+	worker = TVmaze_sync(app, app.config['SYNC_INTERVAL'], app.config['SYNC_WORKERS'], app.config['SYNC_BATCH_SIZE'])
+	worker.lock = lock # kept open for as long as the worker runs
+	worker.start()
+	return worker
+
+
+# ================================== import jobs ==================================
+
+class Import_jobs:
+	'''Runs queued import jobs on a pool of worker threads, each job in its own app context and database session.
+	A job is claimed by moving it from queued to running, so a job submitted twice, or by two processes, only runs once.
+	A job still running timeout seconds after it was claimed is taken to have died with its process, and is queued again'''
+
+	def __init__(self, app, workers, timeout):
+		self.app = app
+		self.timeout = timeout
+		self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='import-job')
+
+	def submit(self, job_id):
+		self.pool.submit(self.run, job_id)
+
+	def resume(self):
+		'''Submits the jobs still queued or left running by a process that died, such as those left behind by a restart'''
+
+		with self.app.app_context():
+			self.requeue_stale()
+			job_ids = [job_id for job_id, in db.session.query(TVshow_import_job_table.id).filter_by(status='queued')]
+		for job_id in job_ids:
+			self.submit(job_id)
+
+	def requeue_stale(self):
+		'''Queues and submits the running jobs claimed more than timeout seconds ago, needs an app context'''
+
+		jobs = TVshow_import_job_table.__table__
+		cutoff = datetime.today() - timedelta(seconds=self.timeout)
+		expired = or_(jobs.c.claimed.is_(None), jobs.c.claimed < cutoff) # no claim time means it was never claimed by a live worker
+		stale = [job_id for job_id, in db.session.execute(select(jobs.c.id).where(jobs.c.status == 'running', expired))]
+		requeued = []
+		for job_id in stale: # conditional, another process may requeue it first
+			if db.session.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'running', expired)
+											  .values(status='queued', claimed=None)).rowcount == 1:
+				requeued.append(job_id)
+		db.session.commit()
+		for job_id in requeued:
+			self.app.logger.warning(f"Import job {job_id} was left running, taken to have died with its process and queued again")
+			self.submit(job_id)
+
+	def run(self, job_id):
+		jobs = TVshow_import_job_table.__table__
+		with self.app.app_context():
+			claim = datetime.today()
+			claimed = db.session.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'queued').values(status='running', claimed=claim))
+			db.session.commit()
+			if claimed.rowcount != 1:
+				return # already taken
+			show_query = TVshow_import_job_table.query.get(job_id).name
+			try:
+				response, status = import_shows([show_query])[show_query]
+			except Exception:
+				self.app.logger.exception(f"Import job {job_id} failed")
+				db.session.rollback()
+				response, status = {"message": f"Importing {show_query} failed, please try again"}, 500
+			# only while still this run's claim, a job requeued as stale belongs to its new run
+			db.session.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'running', jobs.c.claimed == claim)
+										   .values(status='finished', result_status=status, result=response,
+												   finished=datetime.today().replace(microsecond=0)))
+			db.session.commit()
+
+
+def show_query_key(show_query):
+	return ' '.join(show_query.lower().replace('-', ' ').split()) # the same normalisation the TVmaze client caches searches under
+
+def queue_import(show_query):
+	'''Queues an import of show_query, unless a job for the same name is already queued or running.
+	Returns that job, and whether it is new'''
+
+	key = show_query_key(show_query)
+	active = TVshow_import_job_table.query.filter(TVshow_import_job_table.query_key == key, TVshow_import_job_table.status != 'finished')
+	job = active.first()
+	if job and job.status == 'running':
+		current_app.extensions['import_jobs'].requeue_stale() # a job whose process died would otherwise hold the name for good
+		db.session.refresh(job)
+	if job:
+		return job, False
+	job = TVshow_import_job_table(name=show_query, query_key=key, status='queued', created=datetime.today().replace(microsecond=0))
+	db.session.add(job)
+	try:
+		db.session.commit()
+	except IntegrityError: # another request queued the same name first
+		db.session.rollback()
+		job = active.first()
+		if job:
+			return job, False
+		raise
+	current_app.extensions['import_jobs'].submit(job.id)
+	return job, True
+
+def job_response(job):
+	'''Generates the json of an import job, the result holds the response importing without a job gives'''
+
+	response = {'id': job.id,
+				'name': job.name,
+				'status': job.status,
+				'created': str(job.created),
+				'_links': {'self': {'href': shows_base() + f'import/jobs/{job.id}'}}}
+	if job.status == 'finished':
+		response['finished'] = str(job.finished)
+		response['result'] = {'status': job.result_status, 'response': job.result}
+	return response
+
+
 # ================================== API endpoint resources and methods ==================================
 
+
+def valid_show_query(show_query):
+	return not re.search('[^a-zA-Z0-9 \'\-]', show_query)
+
+
+def match_shows(show_query, results):
+	'''Splits TVmaze search results into shows matching show_query exactly and the names of similar shows'''
+
+	exact_matches = []
+	similar_matches = []
+	for result in results:
+		show = result['show'] # show key contains the json object with all the information
+		show_name = show['name']
+		show_name_without_symbols = show_name.replace('-', ' ').replace('!', '').replace(':', ' ').replace('.', '').replace('"', '')
+		show_query_without_dash = show_query.replace('-', ' ') # as per assignment specifications
+		if show_name_without_symbols.casefold() == show_query_without_dash.casefold(): # only allowing for identical matches, names can hold regex characters like +1 or C**t
+			exact_matches.append(show)
+		else:
+			similar_matches.append(show_name) # Store similar names - will return this if no matches made 
+	return exact_matches, similar_matches
+
+
+def show_columns(show):
+	'''Maps a TVmaze show json onto TVshow_table columns'''
+
+	return {'tvmaze_id': show['id'], 
+			'name': show['name'], 
+			'Type': show['type'],
+			'language': show['language'],
+			'genres': show['genres'],
+			'status': show['status'],
+			'runtime': show['runtime'],
+			'premiered': datetime.strptime(show['premiered'], "%Y-%m-%d").date() if show['premiered'] else None,
+			'officialSite': show['officialSite'],
+			'schedule': show['schedule'],
+			'rating': show['rating'],
+			'weight': show['weight'],
+			'network': show['network'],
+			'summary': show['summary']}
+
+
+def make_row(show):
+	'''Builds a TVshow_table row object from a TVmaze show json'''
+
+	return TVshow_table(last_updated=datetime.today().replace(microsecond=0), **show_columns(show))
+
+
+def import_shows(show_queries):
+	'''Imports every name in show_queries, searching TVmaze concurrently and inserting all new shows in one transaction.
+	Returns {name: (response json, status code)}, using the same responses as importing a single show'''
+
+	outcomes = {}
+	searches = []
+	for show_query in dict.fromkeys(show_queries): # remove duplicate names, keeping their order
+		if not valid_show_query(show_query): 
+			outcomes[show_query] = {"message": f"Invalid characters used in query {show_query}, please use only alphanumeric characters" }, 400
+		else:
+			searches.append(show_query)
+
+	metrics = request_metrics.get()
+	tvmaze = tvmaze_client()
+	def search(show_query):
+		request_metrics.set(metrics) # count the pool's TVmaze calls towards this request
+		try:
+			return tvmaze.search_shows(show_query)
+		except (requests.RequestException, ValueError):
+			return None # one failed lookup shouldn't fail the whole batch
+
+	with ThreadPoolExecutor(max_workers=current_app.config['TVMAZE_WORKERS']) as pool:
+		matches = {}
+		for show_query, results in zip(searches, pool.map(search, searches)):
+			if results is None:
+				outcomes[show_query] = {"message": f"TVmaze could not be reached while searching for {show_query}"}, 502
+			else:
+				matches[show_query] = match_shows(show_query, results)
+
+	# check every matched show against the database at once
+	tvmaze_ids = {show['id'] for exact_matches, _ in matches.values() for show in exact_matches}
+	stored = {row.tvmaze_id : row for row in TVshow_table.query.filter(TVshow_table.tvmaze_id.in_(tvmaze_ids))} if tvmaze_ids else {}
+
+	imported = {}
+	duplicates = {}
+	claimed = set(stored)
+	for show_query, (exact_matches, similar_matches) in matches.items():
+		if not exact_matches:
+			if similar_matches:
+				outcomes[show_query] = {"message": f"Show {show_query} not found, however similar shows were found", "similar" : similar_matches}, 404
+			else:
+				outcomes[show_query] = {"message": f"Show {show_query} not found"}, 404
+			continue
+		stored_matches = [show for show in exact_matches if show['id'] in claimed]
+		if stored_matches:
+			duplicates[show_query] = stored_matches[0]
+			continue
+		claimed.update(show['id'] for show in exact_matches) # a later name matching the same show gets a 409
+		imported[show_query] = exact_matches
+
+	committed = {}
+	while imported:
+		rows = {show_query : [make_row(show) for show in shows] for show_query, shows in imported.items()}
+		new_rows = [row for show_rows in rows.values() for row in show_rows]
+		db.session.add_all(new_rows)
+		try:
+			db.session.flush() # assigns the new ids
+			update_show_tables([(row.id, None, show_snapshot(row)) for row in new_rows])
+			affected = with_neighbours([row.id for row in new_rows]) # the shows before them gain a next link
+			db.session.commit() # One transaction for the whole batch
+		except IntegrityError: # another request or worker stored some of these shows since they were checked
+			db.session.rollback()
+			tvmaze_ids = {show['id'] for shows in imported.values() for show in shows}
+			collisions = {row.tvmaze_id : row for row in TVshow_table.query.filter(TVshow_table.tvmaze_id.in_(tvmaze_ids))}
+			if not collisions:
+				raise
+			stored.update(collisions)
+			for show_query, shows in list(imported.items()): # those names get a 409, the rest are tried again
+				collided = [show for show in shows if show['id'] in collisions]
+				if collided:
+					duplicates[show_query] = collided[0]
+					del imported[show_query]
+			continue
+		invalidate_rows(affected)
+		committed = rows
+		break
+	for show_rows in committed.values():
+		stored.update({row.tvmaze_id : row for row in show_rows})
+
+	for show_query, show in duplicates.items(): # hrefs built after the commit, as the show may have been imported by this batch
+		outcomes[show_query] = {"message" : f"The show {show['name']} is already stored in this database",
+								show['name'] : {'href' : shows_base() + str(stored[show['id']].id)}}, 409
+	for show_query, rows in committed.items():
+		responses = [generate_response(TVshow) for TVshow in rows]
+		if len(responses) > 1:
+			outcomes[show_query] = {"message" : f"More than one show matched the name {show_query} exactly", "shows" : responses}, 201
+		else:
+			outcomes[show_query] = {"message" : f"{show_query} imported", show_query : responses[0]}, 201
+	return {show_query : outcomes[show_query] for show_query in dict.fromkeys(show_queries)}
+
+
 TVshow_import_args = reqparse.RequestParser()
 TVshow_import_args.add_argument("name", type=str, help="Name of TV show is required", required=True)
+TVshow_import_args.add_argument("async", type=inputs.boolean, help="Use true or false.", default=False)
 
 @api.route('/tv-shows/import')
 @api.param('name', 'Name of TV show')
+@api.param('async', 'true to queue the import and return straight away, then follow the job link for its result')
 class TVshow_import(Resource):
 	@api.response(201, 'TV show added to database')
+	@api.response(202, 'Import queued, see the job for its result')
 	@api.response(400, 'Invalid request')
 	@api.response(404, 'TV show not found')
 	@api.response(409, 'TV show already in database')
@@ -183,83 +1385,165 @@ class TVshow_import(Resource):
 	def post(self):
 		query = TVshow_import_args.parse_args()
 		show_query = query.get('name')
-		if re.search('[^a-zA-Z0-9 \'\-]', show_query): 
-			return {"message": f"Invalid characters used in query {show_query}, please use only alphanumeric characters" }, 400
-		
-		tvmaze_base = 'http://api.tvmaze.com/search/shows?q='
-		response = requests.get(tvmaze_base + show_query) # Get response object from querying tvmaze
-		results = response.json() # Extract only the json payload of response - list of jsons
-		if results:
-			exact_matches = []
-			similar_matches = []
-			for result in results:
-				show = result['show'] # show key contains the json object with all the information
-				show_name = show['name']
-				show_name_without_symbols = show_name.replace('-', ' ').replace('!', '').replace(':', ' ').replace('.', '').replace('"', '')
-				show_query_without_dash = show_query.replace('-', ' ') # as per assignment specifications
-				tvmaze_id = show['id']
-				if re.search('^' + show_name_without_symbols + '$', show_query_without_dash, re.IGNORECASE): # only allowing for identical matches		
-					check_row = TVshow_table.query.filter_by(tvmaze_id=tvmaze_id).first() # Returns None if no result
-					if check_row:
-						return {"message" : f"The show {show_name} is already stored in this database",
-								show_name : {'href' : base + str(check_row.id)}}, 409
-
-					TVshow = TVshow_table(tvmaze_id=tvmaze_id, 
-										name=show_name, 
-										last_updated=datetime.today().replace(microsecond=0),
-										Type=show['type'],
-										language=show['language'],
-										genres=show['genres'],
-										status=show['status'],
-										runtime=show['runtime'],
-										premiered= datetime.strptime(show['premiered'], "%Y-%m-%d").date(),
-										officialSite=show['officialSite'],
-										schedule=show['schedule'],
-										rating=show['rating'],
-										weight=show['weight'],
-										network=show['network'],
-										summary=show['summary'],
-										) 
-					exact_matches.append(TVshow) # Store row objects 
-				else:
-					similar_matches.append(show_name) # Store similar names - will return this if no matches made 
-			if exact_matches:
-				responses = []
-				for TVshow in exact_matches:
-					db.session.add(TVshow)
-					db.session.commit() # Add TVshow row object into sqlite database
-					responses.append(generate_response(TVshow)) # Response 
-				if len(responses) > 1:
-					return {"message" : f"More than one show matched the name {show_query} exactly", "shows" : responses}, 201
-				else:
-					return {"message" : f"{show_query} imported", show_query : responses[0]}, 201
-			elif similar_matches:
-				return {"message": f"Show {show_query} not found, however similar shows were found", "similar" : similar_matches}, 404
-			return {"message": f"Show {show_query} not found"}, 404
-		return {"message": f"Show {show_query} not found"}, 404
+		if query['async']:
+			if not valid_show_query(show_query):
+				return {"message": f"Invalid characters used in query {show_query}, please use only alphanumeric characters" }, 400
+			job, created = queue_import(show_query)
+			message = f"Import of {show_query} queued" if created else f"Import of {job.name} is already {job.status}"
+			response = job_response(job)
+			return {"message": message, "job": response}, 202, {'Location': response['_links']['self']['href']}
+		return import_shows([show_query])[show_query]
+
+
+@api.route('/tv-shows/import/jobs/<int:id>')
+@api.param('id', 'ID of the import job')
+class TVshow_import_job(Resource):
+	@api.response(200, 'Job successfully retrieved')
+	@api.response(404, 'job ID was not found')
+	@api.doc(description="Get the state of an import job, finished jobs include the result of the import (201, 400, 404, 409 or 502)")
+	def get(self, id):
+		job = TVshow_import_job_table.query.get(id)
+		if job is None:
+			return {"message" : f"Import job {id} does not exist"}, 404
+		if job.status == 'running':
+			current_app.extensions['import_jobs'].requeue_stale() # so a job whose process died is picked up again
+			db.session.refresh(job)
+		return job_response(job), 200
+
+
+TVshow_batch_import_model = api.model('TVshow_batch_import', {
+	'names': fields.List(fields.String(example="Breaking Bad"), required=True, description="Names of TV shows to import")
+})
+
+@api.route('/tv-shows/import/batch')
+class TVshow_batch_import(Resource):
+	@api.response(200, 'Every name was processed, see each result for its outcome')
+	@api.response(400, 'Invalid request')
+	@api.doc(description="Add many TV shows to the database at once\n\n"
+						 "Each name gets the same result as importing it on its own (201, 400, 404 or 409), "
+						 "all imported shows are stored in a single transaction")
+	@api.expect(TVshow_batch_import_model, validate=True)
+	def post(self):
+		show_queries = request.json['names']
+		if len(show_queries) > current_app.config['IMPORT_BATCH_LIMIT']:
+			return {"message": f"At most {current_app.config['IMPORT_BATCH_LIMIT']} names can be imported per request"}, 400
+		results = []
+		for show_query, (response, status) in import_shows(show_queries).items():
+			results.append({"name": show_query, "status": status, "response": response})
+		return {"results": results}, 200
 
 
 order_by_attributes = ["id","name","runtime","premiered","rating-average"]
 filter_by_attributes = ["tvmaze_id" ,"id" ,"last-update" ,"name" ,"type" ,"language" ,"genres" ,"status", 
 						"runtime" ,"premiered" ,"officialSite" ,"schedule" ,"rating" ,"weight" ,"network" ,"summary"]
 
+# filter attribute -> (key in the response, column it is read from, conversion or None)
+filter_by_columns = {
+	"tvmaze_id": ("tvmaze_id", TVshow_table.tvmaze_id, None),
+	"id": ("id", TVshow_table.id, None),
+	"last-update": ("last_updated", TVshow_table.last_updated, str), # Convert datetime object to string
+	"name": ("name", TVshow_table.name, None),
+	"type": ("Type", TVshow_table.Type, None),
+	"language": ("language", TVshow_table.language, None),
+	"genres": ("genres", TVshow_table.genres, None),
+	"status": ("status", TVshow_table.status, None),
+	"runtime": ("runtime", TVshow_table.runtime, None),
+	"premiered": ("premiered", TVshow_table.premiered, str), # Convert date object to string
+	"officialSite": ("officialSite", TVshow_table.officialSite, None),
+	"schedule": ("schedule", TVshow_table.schedule, None),
+	"rating": ("average rating", TVshow_table.rating_average, None), # no need to load the rating json
+	"weight": ("weight", TVshow_table.weight, None),
+	"network": ("network", TVshow_table.network, None),
+	"summary": ("summary", TVshow_table.summary, None),
+}
+
+@lru_cache(maxsize=256)
+def compile_filter(filter_by_attributes, order_by_attributes=()):
+	'''Compiles a filter into the columns to select and a serializer list of (key, row position, conversion).
+	Columns needed by order_by are selected as well, so cursors can be built from the same rows'''
+
+	columns = []
+	serializers = []
+	for attribute in filter_by_attributes:
+		key, column, conversion = filter_by_columns[attribute]
+		if column not in columns:
+			columns.append(column)
+		serializers.append((key, columns.index(column), conversion))
+	for order_by_attribute in order_by_attributes:
+		column = order_by_column(order_by_attribute[1:])
+		if column not in columns:
+			columns.append(column)
+	return tuple(columns), tuple(serializers)
+
+def serialize_rows(rows, serializers):
+	'''Turns projected rows into response dicts'''
+
+	return [{key : row[position] if conversion is None else conversion(row[position]) for key, position, conversion in serializers}
+			for row in rows]
+
 TVshows_parser = reqparse.RequestParser()
 TVshows_parser.add_argument("order_by", type=parse_order_by_param, help="Use comma seperated attributes starting with + or -:", default=["+id"])
 TVshows_parser.add_argument("filter", type=parse_filter_by_param, help="Use comma seperated attributes:", default=["id","name"])
 TVshows_parser.add_argument("page", type=int, help="Enter positive integer only.", default=1)
 TVshows_parser.add_argument("page_size", type=int, help="Enter positive integer only.", default=100)
+TVshows_parser.add_argument("cursor", type=str, help="Use 'start' or a cursor returned in _links.")
+TVshows_parser.add_argument("genres", type=parse_list_param, help="Use comma seperated genres:")
+TVshows_parser.add_argument("language", type=parse_list_param, help="Use comma seperated languages:")
+TVshows_parser.add_argument("status", type=parse_list_param, help="Use comma seperated statuses:")
+TVshows_parser.add_argument("type", type=parse_list_param, help="Use comma seperated types:")
+TVshows_parser.add_argument("runtime_min", type=int, help="Enter an integer only.")
+TVshows_parser.add_argument("runtime_max", type=int, help="Enter an integer only.")
+TVshows_parser.add_argument("premiered_after", type=lambda x: datetime.strptime(x, "%Y-%m-%d").date(), help="Use YYYY-MM-DD format:")
+TVshows_parser.add_argument("premiered_before", type=lambda x: datetime.strptime(x, "%Y-%m-%d").date(), help="Use YYYY-MM-DD format:")
+predicate_params = ["genres", "language", "status", "type", "runtime_min", "runtime_max", "premiered_after", "premiered_before"]
+
+def show_predicates(args):
+	'''Builds SQL WHERE clauses for the predicate parameters given in args, each one backed by an index'''
+
+	predicates = []
+	if args['genres']:
+		predicates.append(TVshow_table.id.in_(select(TVshow_genre_table.show_id).where(TVshow_genre_table.genre.in_(args['genres']))))
+	for attribute, column in [('language', TVshow_table.language), ('status', TVshow_table.status), ('type', TVshow_table.Type)]:
+		if args[attribute]:
+			predicates.append(column.in_(args[attribute]))
+	if args['runtime_min'] is not None:
+		predicates.append(TVshow_table.runtime >= args['runtime_min'])
+	if args['runtime_max'] is not None:
+		predicates.append(TVshow_table.runtime <= args['runtime_max'])
+	if args['premiered_after'] is not None:
+		predicates.append(TVshow_table.premiered >= args['premiered_after'])
+	if args['premiered_before'] is not None:
+		predicates.append(TVshow_table.premiered <= args['premiered_before'])
+	return predicates
+
+def predicate_query():
+	'''The predicate parameters of this request, for building page links'''
+
+	return ''.join(f'&{param}={quote(request.args[param], safe=",")}' for param in predicate_params if param in request.args)
 
 @api.route('/tv-shows')
 @api.param('order_by', 'Sort in acending order using +, decending using -, append symbol to start of attribute')
 @api.param('filter', 'Filter supported attributes, comma seperated')
 @api.param('page', 'The page number to display from the query')
 @api.param('page_size', 'The size of each page generated from the query')
+@api.param('cursor', 'Keyset pagination cursor, use "start" for the first page then follow the next/previous links')
+@api.param('genres', 'Only shows having any of these comma seperated genres')
+@api.param('language', 'Only shows in any of these comma seperated languages')
+@api.param('status', 'Only shows with any of these comma seperated statuses')
+@api.param('type', 'Only shows of any of these comma seperated types')
+@api.param('runtime_min', 'Only shows with at least this runtime')
+@api.param('runtime_max', 'Only shows with at most this runtime')
+@api.param('premiered_after', 'Only shows premiered on or after this date, YYYY-MM-DD')
+@api.param('premiered_before', 'Only shows premiered on or before this date, YYYY-MM-DD')
 @api.doc(description="Specify parameters to return a sorted/filterd list of avaliable shows\n\n"
 					"--order_by: accepts: [id,name,runtime,premiered,rating-average], usage: +runtime,-id,+name\n\n"
 					"--filter:  accepts: [tvmaze_id ,id ,last-update ,name ,type ,language ,genres ,status ,runtime ,"
 					"premiered ,officialSite ,schedule ,rating ,weight ,network ,summary], useage: id,name,summary\n\n"
 					"--page: accepts any positive integer\n\n"
-					"--page_size: accepts any positive integer")
+					"--page_size: accepts any positive integer\n\n"
+					"--cursor: accepts 'start' or a cursor from _links, replaces page and scales to any catalog size\n\n"
+					"--genres, language, status, type: comma seperated values, a show matches if it has any of them\n\n"
+					"--runtime_min, runtime_max, premiered_after, premiered_before: inclusive ranges")
 class TVshows(Resource):
 	@api.response(200, 'successful ordering and filtering of database')
 	@api.response(400, 'Invalid request')
@@ -270,51 +1554,45 @@ class TVshows(Resource):
 		filter_by_attributes = args['filter']
 		page_no = args['page']
 		page_size = args['page_size']
+		predicates = show_predicates(args)
 
-		if len(TVshow_table.query.all()) == 0:
-			return {"message": f"Database is empty, please add some entries before using the get method"}, 409 
+		# every write bumps the data version, so it and the query string identify the page
+		etag = make_etag(data_version(), request.full_path)
+		unchanged = not_modified(etag)
+		if unchanged:
+			return unchanged
 
-		number_of_pages = TVshow_table.query.paginate(per_page=page_size, page=1).pages # paginate method automatically parses any parameter named 'page' hence, setting have to set to 1
-		if number_of_pages < page_no:
-			return {"message": f"Pagination error, page {page_no} was requested, but only {number_of_pages} pages exist"}, 400 
+		if args['cursor'] is not None:
+			response = self.get_keyset_page(order_by_attributes, filter_by_attributes, page_size, args['cursor'], predicates)
+			if not isinstance(response, tuple): # errors aren't cacheable
+				response.headers.extend(validator_headers(etag))
+			return response
 
-		rows = TVshow_table.query # return basequery object 
+		if page_no < 1 or page_size < 1:
+			return {"message": f"Pagination error, page and page_size must be positive integers"}, 400
+		columns, serializers = compile_filter(tuple(filter_by_attributes))
+		rows = db.session.query(*columns).filter(*predicates) # only select the filtered columns
 
 		# ordering
 		for order_by_attribute in order_by_attributes:
 			direction = order_by_attribute[:1]
-			attribute = order_by_attribute[1:]
-			if attribute == 'rating-average':
-				attribute = 'rating'
+			column = order_by_column(order_by_attribute[1:])
 			if direction == '+':
-				rows = rows.order_by(getattr(TVshow_table, attribute).asc()) # order_by basequery method requires a column like object
+				rows = rows.order_by(column.asc()) # order_by basequery method requires a column like object
 			else:
-				rows = rows.order_by(getattr(TVshow_table, attribute).desc()) 
+				rows = rows.order_by(column.desc()) 
 
 		# pagination
-		rows = rows.paginate(per_page=page_size, page=page_no) # Again, don't need to specify page=page_no since paginate method auto parses 'page' param, just being explicit
-
-		page_of_shows = {"page":page_no, "page-size":page_size, "tv-shows":[], "_links":{}}
-		for show in rows.items:
-			filtered_show = {}
-			for attribute in filter_by_attributes:
-				if attribute == 'last-update':
-					attribute = 'last_updated'
-					filtered_show[attribute] = str(getattr(show, attribute)) # Convert datetime object to string
-					continue
-				elif attribute == 'premiered':
-					filtered_show[attribute] = str(getattr(show, attribute)) # Convert datetime object to string
-					continue
-				elif attribute == 'rating':
-					filtered_show['average ' + attribute] = getattr(show, attribute)['average']
-					continue
-				elif attribute == 'type':
-					attribute = 'Type'
-				filtered_show[attribute] = getattr(show, attribute)
-			page_of_shows["tv-shows"].append(filtered_show)
+		rows = rows.paginate(per_page=page_size, page=page_no, error_out=False) # one count and one page query, out of range pages are checked below
+		if rows.total == 0 and not predicates:
+			return {"message": f"Database is empty, please add some entries before using the get method"}, 409 
+		if max(rows.pages, 1) < page_no: # nothing matching the predicates is still a valid, empty, first page
+			return {"message": f"Pagination error, page {page_no} was requested, but only {rows.pages} pages exist"}, 400 
+
+		page_of_shows = {"page":page_no, "page-size":page_size, "tv-shows":serialize_rows(rows.items, serializers), "_links":{}}
 		
 		def make_href(sign):
-			return {"href" : base[:-1] + f'?order_by={",".join(order_by_attributes)}&page={page_no + sign}&page_size={page_size}&filter={",".join(filter_by_attributes)}'}
+			return {"href" : shows_base()[:-1] + f'?order_by={quote(",".join(order_by_attributes), safe=",")}&page={page_no + sign}&page_size={page_size}&filter={",".join(filter_by_attributes)}{predicate_query()}'}
 
 		# hrefs
 		page_of_shows["_links"]["self"] = make_href(0)
@@ -322,7 +1600,170 @@ class TVshows(Resource):
 			page_of_shows["_links"]["previous"] = make_href(-1)
 		if page_no < rows.pages:
 			page_of_shows["_links"]["next"] = make_href(1)
-		return page_of_shows, 200
+		response = json_response(page_of_shows)
+		response.headers.extend(validator_headers(etag))
+		return response
+
+	def get_keyset_page(self, order_by_attributes, filter_by_attributes, page_size, cursor, predicates):
+		'''Returns the page after (or before) cursor using a single range query, without counting or offsetting'''
+
+		if page_size < 1:
+			return {"message": f"Pagination error, page_size must be a positive integer"}, 400
+		direction, values = 'next', None
+		if cursor != 'start':
+			try:
+				direction, values = decode_cursor(cursor, order_by_attributes)
+			except Exception as error:
+				return {"message": str(error)}, 400
+		reverse = direction == 'previous' # walk the ordering backwards, then flip the page back around
+
+		columns, serializers = compile_filter(tuple(filter_by_attributes), tuple(keyset_order(order_by_attributes)))
+		rows = db.session.query(*columns).filter(*predicates) # the filtered columns plus the sort key
+		if values is not None:
+			rows = rows.filter(keyset_filter(order_by_attributes, values, reverse))
+		for order_by_attribute in keyset_order(order_by_attributes):
+			column = order_by_column(order_by_attribute[1:])
+			rows = rows.order_by(column.asc() if (order_by_attribute[0] == '+') != reverse else column.desc())
+		rows = rows.limit(page_size + 1).all() # one extra row tells us whether there is another page
+		more = len(rows) > page_size
+		rows = rows[:page_size]
+		if reverse:
+			rows.reverse()
+
+		if not rows and values is None and not predicates:
+			return {"message": f"Database is empty, please add some entries before using the get method"}, 409
+
+		def make_href(cursor):
+			return {"href" : shows_base()[:-1] + f'?order_by={quote(",".join(order_by_attributes), safe=",")}&cursor={cursor}&page_size={page_size}&filter={",".join(filter_by_attributes)}{predicate_query()}'}
+
+		page_of_shows = {"page-size":page_size, "tv-shows":serialize_rows(rows, serializers), "_links":{"self" : make_href(cursor)}}
+		if rows and (values is not None if not reverse else more):
+			page_of_shows["_links"]["previous"] = make_href(encode_cursor(order_by_attributes, rows[0], 'previous'))
+		if rows and (more if not reverse else True):
+			page_of_shows["_links"]["next"] = make_href(encode_cursor(order_by_attributes, rows[-1], 'next'))
+		return json_response(page_of_shows)
+
+
+TVshow_export_parser = TVshows_parser.copy()
+for argument in ["page", "page_size", "cursor"]:
+	TVshow_export_parser.remove_argument(argument)
+TVshow_export_parser.replace_argument("filter", type=parse_filter_by_param, help="Use comma seperated attributes:", default=filter_by_attributes)
+TVshow_export_parser.add_argument("format", type=str, help="Use ndjson or csv.", default="ndjson")
+
+def export_chunks(engine, columns, serializers, predicates, order_by_attributes, output, chunk_size):
+	'''Yields the export body a chunk of rows at a time, reading them off one streaming select so memory stays flat'''
+
+	with engine.connect() as connection:
+		rows = select(*columns).where(*predicates)
+		for order_by_attribute in keyset_order(order_by_attributes): # ends with id, so the order is total
+			column = order_by_column(order_by_attribute[1:])
+			rows = rows.order_by(column.asc() if order_by_attribute[0] == '+' else column.desc())
+		result = connection.execution_options(stream_results=True).execute(rows)
+		keys = [key for key, _, _ in serializers]
+		if output == 'csv':
+			text_buffer = StringIO()
+			writer = csv.writer(text_buffer)
+			writer.writerow(keys)
+		size = min(chunk_size, 50) # a small first chunk gets the first byte out quickly, then chunks grow to chunk_size
+		while True:
+			chunk = result.fetchmany(size)
+			if not chunk:
+				break
+			size = min(size * 2, chunk_size)
+			shows = serialize_rows(chunk, serializers)
+			if output == 'ndjson':
+				if orjson:
+					yield b''.join(orjson.dumps(show) + b'\n' for show in shows)
+				else:
+					yield ''.join(json.dumps(show, separators=(',', ':')) + '\n' for show in shows).encode()
+			else:
+				for show in shows:
+					writer.writerow(['' if show[key] is None else json.dumps(show[key]) if isinstance(show[key], (dict, list)) else show[key]
+									 for key in keys]) # json columns are written as json text
+				yield text_buffer.getvalue().encode()
+				text_buffer.seek(0)
+				text_buffer.truncate()
+		if output == 'csv' and text_buffer.tell():
+			yield text_buffer.getvalue().encode() # the header of an empty export
+
+@api.route('/tv-shows/export')
+@api.param('format', 'The format of the export, either "ndjson" (one json show per line) or "csv"')
+@api.param('order_by', 'Sort in acending order using +, decending using -, append symbol to start of attribute')
+@api.param('filter', 'Filter supported attributes, comma seperated, every attribute by default')
+@api.param('genres', 'Only shows having any of these comma seperated genres')
+@api.param('language', 'Only shows in any of these comma seperated languages')
+@api.param('status', 'Only shows with any of these comma seperated statuses')
+@api.param('type', 'Only shows of any of these comma seperated types')
+@api.param('runtime_min', 'Only shows with at least this runtime')
+@api.param('runtime_max', 'Only shows with at most this runtime')
+@api.param('premiered_after', 'Only shows premiered on or after this date, YYYY-MM-DD')
+@api.param('premiered_before', 'Only shows premiered on or before this date, YYYY-MM-DD')
+@api.doc(description="Stream every show matching the filters in one response, ordered and filtered like the list of shows but without pages")
+class TVshows_export(Resource):
+	@api.response(200, 'successful export of the database')
+	@api.response(400, 'Invalid request')
+	@api.response(409, 'Database is empty')
+	def get(self):
+		args = TVshow_export_parser.parse_args()
+		output = args['format']
+		if output not in ['ndjson', 'csv']:
+			return {"message": f"Format parameter accepts only 'ndjson' or 'csv'"}, 400
+		if db.session.query(TVshow_table.id).first() is None:
+			return {"message": f"Database is empty, please add some entries before using the get method"}, 409
+		db.session.rollback() # the export reads on its own connection, this one goes back to the pool
+		columns, serializers = compile_filter(tuple(args['filter']))
+		body = export_chunks(db.engine, columns, serializers, show_predicates(args), args['order_by'], output, current_app.config['EXPORT_CHUNK_SIZE'])
+		mimetype = 'application/x-ndjson' if output == 'ndjson' else 'text/csv'
+		return Response(body, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename=tv-shows.{output}'})
+
+TVshow_search_parser = reqparse.RequestParser()
+TVshow_search_parser.add_argument("q", type=str, help="Words to search for are required", required=True)
+TVshow_search_parser.add_argument("page", type=int, help="Enter positive integer only.", default=1)
+TVshow_search_parser.add_argument("page_size", type=int, help="Enter positive integer only.", default=20)
+
+@api.route('/tv-shows/search')
+@api.param('q', 'Words to search the name, summary and genres of stored shows for, matches words starting with them')
+@api.param('page', 'The page number of the results to display')
+@api.param('page_size', 'The number of results on each page')
+@api.doc(description="Full text search over the shows stored in the database, best matches first\n\n"
+					"--q: words to search for, every word has to match, e.g. detective river\n\n"
+					"--page: accepts any positive integer\n\n"
+					"--page_size: accepts any positive integer")
+class TVshow_search(Resource):
+	@api.response(200, 'successful search of database')
+	@api.response(400, 'Invalid request')
+	def get(self):
+		args = TVshow_search_parser.parse_args()
+		show_query = args['q']
+		page_no = args['page']
+		page_size = args['page_size']
+		if page_no < 1 or page_size < 1:
+			return {"message": f"Pagination error, page and page_size must be positive integers"}, 400
+		words = re.findall(r'\w+', show_query)
+		if not words:
+			return {"message": f"Query {show_query} has no words to search for"}, 400
+		match = ' '.join(f'"{word}"*' for word in words) # quoted so user input is never read as FTS5 syntax
+
+		# name matches weigh the most, then genres, then the summary
+		rows = db.session.execute(text(f'SELECT {search_table}.rowid AS id, {TVshow_table.__tablename__}.name AS name, '
+									   f'bm25({search_table}, 10.0, 1.0, 5.0) AS rank '
+									   f'FROM {search_table} JOIN {TVshow_table.__tablename__} ON {TVshow_table.__tablename__}.id = {search_table}.rowid '
+									   f'WHERE {search_table} MATCH :match ORDER BY rank LIMIT :limit OFFSET :offset'),
+								  {'match': match, 'limit': page_size + 1, 'offset': (page_no - 1) * page_size}).fetchall()
+		more = len(rows) > page_size # one extra row tells us whether there is another page
+
+		def make_href(page):
+			return {"href" : shows_base()[:-1] + f'/search?q={quote(show_query)}&page={page}&page_size={page_size}'}
+
+		results = {"q": show_query, "page": page_no, "page-size": page_size, "results": [], "_links": {"self": make_href(page_no)}}
+		for row in rows[:page_size]:
+			results["results"].append({"id": row.id, "name": row.name, "score": round(-row.rank, 4), # bm25 is lower for better matches
+									   "_links": {"self": {"href": shows_base() + str(row.id)}}})
+		if page_no > 1:
+			results["_links"]["previous"] = make_href(page_no - 1)
+		if more:
+			results["_links"]["next"] = make_href(page_no + 1)
+		return json_response(results)
 
 
 TVshow_statistics_parser = reqparse.RequestParser()
@@ -349,59 +1790,44 @@ class TVshow_statistics(Resource):
 			return {"message": f"Output parameter accepts only 'json' or 'image'"}, 400 
 		if attribute not in ['language', 'genres', 'status', 'type']:
 			return {"message": f"'by' parameter accepts only [language, genres, status, type] attributes"}, 400
-		if len(TVshow_table.query.all()) == 0:
+		total = db.session.query(TVshow_statistic_table.count).filter_by(attribute='total', value='').scalar() or 0
+		if total == 0:
 			return {"message": f"Database is empty, please add some entries before using the get method"}, 409 
 
-		# load in database
-		conn = sqlite3.connect('z5017350.db')
-		df_shows = pd.read_sql_query(f"SELECT * FROM {TVshow_table.__tablename__}", conn) # load all rows from table into dataframe object 
-		total = df_shows.shape[0]
-
-		past_24hr = timedelta(hours=24)
-		current_time = datetime.now()
-		recently_updated_shows = df_shows.last_updated\
-								.apply(lambda date: True if datetime.strptime(date, "%Y-%m-%d %H:%M:%S.%f") + past_24hr >= current_time else False)\
-								.value_counts()[True] # datetime objects seem to have become strings, so convert them back to datetime
-
-		if attribute in ['language', 'status', 'type']:
-			attribute = 'Type' if attribute == 'type' else attribute
-			df_shows_counts = df_shows.groupby(attribute).id.count().sort_values(ascending=False)
-		else:
-			df_shows.genres = df_shows.genres.apply(lambda genres: pd.NA if genres == '[]' else genres[1:-1].split(','))
-			df_shows.dropna(subset=['genres'], how='all', inplace=True)
-			df_shows_counts = df_shows.explode(attribute).groupby(attribute).id.count().sort_values(ascending=False)
-			df_shows_counts.index = df_shows_counts.index.str.replace('"', '') # remove quotations from genres index
-		
-		df_shows_percentage = df_shows_counts.apply(lambda count: round((count / total) * 100))
+		# read in the aggregates, never the shows themselves
+		recently_updated_shows = db.session.query(func.count(TVshow_table.id))\
+								.filter(TVshow_table.last_updated >= datetime.now() - timedelta(hours=24))\
+								.scalar() # range scan over the last_updated index
+		counts = db.session.query(TVshow_statistic_table.value, TVshow_statistic_table.count)\
+								.filter(TVshow_statistic_table.attribute == attribute, TVshow_statistic_table.count > 0)\
+								.order_by(TVshow_statistic_table.count.desc(), TVshow_statistic_table.value)\
+								.all()
+		attribute = 'Type' if attribute == 'type' else attribute
+		values = [value for value, count in counts]
+		percentages = [round((count / total) * 100) for value, count in counts]
 
 		if output == 'json':
-			response_json = {"total": int(total), "total-updated": int(recently_updated_shows), "values %": {}} # Convert numpy int64 to python int objects 
-			for index, row in df_shows_percentage.iteritems():
-				response_json["values %"].update({index:str(row) + "%"})
+			response_json = {"total": total, "total-updated": recently_updated_shows, "values %": {}}
+			for value, percentage in zip(values, percentages):
+				response_json["values %"].update({value:str(percentage) + "%"})
 			return response_json, 200
 		else:
-			fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(10, 7)) #, 
-			width = 0.4
-			x =  np.arange(len(df_shows_percentage))
-			rects = ax.bar(x, df_shows_percentage, width , label=f'{attribute} (with number of occurrences)')
-			line2, = plt.plot([], label=f"Total number of shows: {total}", linestyle='')
-			line3, = plt.plot([], label=f"Recently updated shows: {recently_updated_shows}", linestyle='')
-
-			ax.legend(fontsize='large', loc='best')
-			ax.set_ylabel('Percentage %', fontsize='large')
-			ax.set_xlabel(attribute, fontsize='large')
-			ax.set_ylim([0, 100])
-			ax.set_title(f'Percentage of shows in the database against {attribute}')
-			ax.set_xticks(x)
-			ax.set_xticklabels(df_shows_percentage.index)
-			fig.autofmt_xdate(rotation=45)
-
-			ax.bar_label(rects, labels=df_shows_counts.tolist() , padding=3)
-			plt.style.use('seaborn')
-			plt.tight_layout()
-			image_file = f'{attribute}.png'
-			plt.savefig(image_file, facecolor='w', bbox_inches='tight')
-			return send_file(image_file, as_attachment=True, attachment_filename=image_file, mimetype='image/png', cache_timeout=0) # Sorry I just can't workout how to make it display on browser 
+			# recently updated shows age out without any writes, so it is part of the data version
+			key = (attribute, data_version(), recently_updated_shows)
+			etag = '-'.join(str(part) for part in key)
+			if etag in request.if_none_match:
+				response = make_response('', 304)
+			else:
+				png = current_app.extensions['chart_cache'].get(key)
+				if png is None:
+					png = render_chart(attribute, values, percentages, [count for value, count in counts], total, recently_updated_shows)
+					current_app.extensions['chart_cache'].put(key, png)
+				response = make_response(png)
+				response.mimetype = 'image/png'
+				response.headers['Content-Disposition'] = f'attachment; filename={attribute}.png'
+			response.set_etag(etag)
+			response.cache_control.no_cache = True # clients have to revalidate, which costs nothing while the data is unchanged
+			return response
 
 			 	
  # api.model() does not appear to be able to enforce datetime types, hence using reqparser as well 
@@ -415,6 +1841,188 @@ TVshow_args = reqparse.RequestParser()
 TVshow_args.add_argument("premiered", type=lambda x: datetime.strptime(x, "%Y-%m-%d"), help="Invalid parameter for premiered. Use YYYY-MM-DD format:", required=False)
 
 
+def patch_values(row, patch_request):
+	'''Works out the columns patch_request changes on row, checking its keys against TVshow_model and the nested jsons already stored.
+	Returns (column values, None), or (None, error message), row itself is left untouched'''
+
+	values = {}
+	for key in patch_request:
+
+		# Checking whether user entered keys are valid. 
+		if key not in TVshow_model.keys():
+			return None, f"Invalid key {key}, please refer to table model for valid keys"
+
+		# Checking whether nested keys are valid, and if so, apply modifications to a copy of the stored json. 
+		if key in ['schedule', 'rating', 'network']:
+			model_dict = getattr(row, key) or {}
+			modified_dict = model_dict.copy()
+			query_dict = patch_request[key]
+			for nested_key in query_dict:
+				if nested_key not in model_dict.keys():
+					return None, f"Invalid key {nested_key}, please refer to table model for valid keys"
+				if nested_key == 'country':
+					inner_modified_dict = model_dict[nested_key].copy()
+					for nested_nested_key in query_dict[nested_key]:
+						if nested_nested_key not in model_dict[nested_key].keys():
+							return None, f"Invalid key {nested_nested_key}, please refer to table model for valid keys"
+						inner_modified_dict[nested_nested_key] = query_dict[nested_key][nested_nested_key]
+					modified_dict[nested_key] = inner_modified_dict
+					continue
+				modified_dict[nested_key] = query_dict[nested_key]
+			values[key] = modified_dict
+			continue
+
+		# Special case, column type is date, user can input date like string, needs to be converted to date object
+		if key == 'premiered': 
+			values[key] = datetime.strptime(patch_request[key], "%Y-%m-%d").date() if patch_request[key] else None
+			continue
+
+		if key == 'tvmaze_id' and patch_request[key] is None:
+			return None, "tvmaze_id cannot be empty"
+
+		values[key] = patch_request[key]
+	return values, None
+
+
+def tvmaze_id_owners(tvmaze_ids):
+	'''Returns {tvmaze id: (id, name)} of the stored shows among tvmaze_ids'''
+
+	owners = {}
+	for chunk in chunks(list(tvmaze_ids), 500): # stays under sqlite's bound parameter limit
+		owners.update({tvmaze_id : (id, name) for tvmaze_id, id, name in db.session.query(TVshow_table.tvmaze_id, TVshow_table.id, TVshow_table.name)
+																								.filter(TVshow_table.tvmaze_id.in_(chunk))})
+	return owners
+
+def tvmaze_id_conflict(owner):
+	'''The 409 response for a patch giving a show the tvmaze_id another show, owner's (id, name), already has'''
+
+	id, name = owner
+	return {"message" : f"The show {name} is already stored in this database with that tvmaze_id", name : {'href' : shows_base() + str(id)}}, 409
+
+
+def check_patch(patch_request):
+	'''The date and time checks the single show patch gets from its reqparsers, for patches sent in a batch.
+	Returns an error message or None'''
+
+	try:
+		if patch_request.get('premiered'):
+			datetime.strptime(patch_request['premiered'], "%Y-%m-%d")
+	except (TypeError, ValueError):
+		return "Invalid parameter for premiered. Use YYYY-MM-DD format:"
+	try:
+		if isinstance(patch_request.get('schedule'), dict) and patch_request['schedule'].get('time') is not None:
+			datetime.strptime(patch_request['schedule']['time'], "%H:%M")
+	except (TypeError, ValueError):
+		return "Invalid parameter for time. Use HH:MM format:"
+	return None
+
+
+def load_shows(ids):
+	'''Returns {id: row} of the stored shows among ids, read with plain selects as rows are not changed through the ORM'''
+
+	table = TVshow_table.__table__
+	rows = {}
+	for chunk in chunks(list(ids), 500): # stays under sqlite's bound parameter limit
+		rows.update({row.id : row for row in db.session.execute(select(table).where(table.c.id.in_(chunk)))})
+	return rows
+
+
+def patch_shows(patches, retried=False):
+	'''Applies {id: patch json} in one transaction, with one executemany UPDATE for each set of changed columns.
+	Every patch is checked first, returns ({id: (response json, status code)}, None),
+	or (None, {id: error message}) when any patch is invalid, in which case nothing is written.
+	Shows missing from the database get a 404, and shows given a tvmaze_id another show has get a 409'''
+
+	rows = load_shows(patches)
+	outcomes = {}
+	errors = {}
+	updates = {}
+	owners = tvmaze_id_owners({patch_request['tvmaze_id'] for patch_request in patches.values() if patch_request.get('tvmaze_id') is not None})
+	for id, patch_request in patches.items():
+		row = rows.get(id)
+		if row is None:
+			outcomes[id] = {"message" : f"ID {id} is not present in the database"}, 404
+			continue
+		values, error = patch_values(row, patch_request)
+		if error:
+			errors[id] = error
+			continue
+		if 'tvmaze_id' in values: # the tvmaze_id index is unique, the first show given a tvmaze_id keeps it
+			owner = owners.setdefault(values['tvmaze_id'], (id, row.name))
+			if owner[0] != id:
+				outcomes[id] = tvmaze_id_conflict(owner)
+				continue
+		if 'rating' in values:
+			values['rating_average'] = (values['rating'] or {}).get('average') # what @validates does for ORM writes
+		values['last_updated'] = next_update_time(row.last_updated)
+		updates[id] = values
+	if errors:
+		db.session.rollback()
+		return None, errors
+
+	table = TVshow_table.__table__
+	statements = {}
+	changes = []
+	patched = {}
+	for id, values in updates.items():
+		statements.setdefault(tuple(sorted(values)), []).append(dict(values, patched_id=id))
+		patched[id] = SimpleNamespace(**dict(rows[id]._mapping, **values))
+		changes.append((id, show_snapshot(rows[id]), show_snapshot(patched[id])))
+	try:
+		for columns, parameters in statements.items():
+			db.session.execute(table.update().where(table.c.id == bindparam('patched_id'))
+												.values({column : bindparam(column, type_=table.c[column].type) for column in columns}), parameters)
+		if changes:
+			update_show_tables(changes)
+		db.session.commit() # One transaction for the whole batch
+	except IntegrityError: # another request gave one of these tvmaze_ids to a show since they were checked
+		db.session.rollback()
+		if retried or not any('tvmaze_id' in values for values in updates.values()):
+			raise
+		return patch_shows(patches, retried=True) # checked again, the clash now gets its 409
+	invalidate_rows(updates)
+	for id, row in patched.items():
+		outcomes[id] = {'message' : f"ID {id} has been patched", id : generate_response(row)}, 200
+	return {id : outcomes[id] for id in patches}, None
+
+
+def delete_shows(ids):
+	'''Deletes every show in ids with set based DELETEs in one transaction, returns {id: (response json, status code)}'''
+
+	rows = load_shows(ids)
+	affected = with_neighbours(rows) # their cached links point at the deleted shows
+	if rows:
+		update_show_tables([(id, show_snapshot(row), None) for id, row in rows.items()])
+		table = TVshow_table.__table__
+		for chunk in chunks(list(rows), 500):
+			db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+	db.session.commit() # One transaction for the whole batch
+	invalidate_rows(affected)
+	return {id : ({"message" : f"The tv show with id {id} was removed from the database!", "id" : id}, 200) if id in rows
+				 else ({"message" : f"ID {id} is not present in the database"}, 404) for id in ids}
+
+
+def where_ids(where):
+	'''Returns the ids of the shows matching a batch request's where json, which takes the list endpoint's predicate parameters.
+	Raises ValueError when where is invalid or would match every show, such as an unknown key or only empty lists'''
+
+	unknown = [key for key in where if key not in predicate_params]
+	if unknown:
+		raise ValueError(f"Invalid key {unknown[0]} in where, use {', '.join(predicate_params)}")
+	args = dict.fromkeys(predicate_params)
+	args.update(where)
+	for param in ['premiered_after', 'premiered_before']:
+		if args[param] is not None:
+			try:
+				args[param] = datetime.strptime(args[param], "%Y-%m-%d").date()
+			except (TypeError, ValueError):
+				raise ValueError(f"Invalid parameter for {param}. Use YYYY-MM-DD format:")
+	predicates = show_predicates(args)
+	if not predicates: # a batch write over the whole catalog has to be asked for one show at a time, or by listing ids
+		raise ValueError(f"where needs at least one of {', '.join(predicate_params)} with a value")
+	return [id for id, in db.session.query(TVshow_table.id).filter(*predicates).order_by(TVshow_table.id)]
+
+
 @api.route('/tv-shows/<int:id>')
 @api.param('id', 'Database ID for TV show')
 class TVshow(Resource):
@@ -422,9 +2030,24 @@ class TVshow(Resource):
 	@api.response(200, 'Show successfully retrieved')
 	@api.doc(description="Get show details by its ID")
 	def get(self, id):
-		row = TVshow_table.query.filter_by(id=id).first()
-		if row:
-			links = generate_href(row.id)
+		cache = current_app.extensions['row_cache']
+		entry = cache.get(id)
+		if entry is None:
+			generation = cache.generation() # read before the show, so a write in between stops the put
+			# validators first, the body includes the neighbour links so they are part of the ETag
+			validators = db.session.query(TVshow_table.last_updated, *neighbour_columns()).filter(TVshow_table.id == id).first()
+			if validators is None:
+				return {"message" : f"ID {id} is not present in the database"}, 404
+			last_updated, previous_id, next_id = validators
+			etag = make_etag(id, last_updated, previous_id, next_id)
+			unchanged = not_modified(etag, last_updated)
+			if unchanged:
+				return unchanged
+
+			row = TVshow_table.query.filter_by(id=id).first()
+			if row is None:
+				return {"message" : f"ID {id} is not present in the database"}, 404
+			links = generate_href(row.id, (previous_id, next_id))
 			response = {
 				'id' : row.id,
 				'tvmaze-id' : row.tvmaze_id,
@@ -444,17 +2067,32 @@ class TVshow(Resource):
 				'summary' : row.summary,
 				'_links' : links
 			}
-			return response, 200
-		return {"message" : f"ID {id} is not present in the database"}, 404
+			entry = json_body(response), etag, last_updated
+			cache.put(id, entry, generation)
+			cached = 'MISS'
+		else:
+			cached = 'HIT'
+
+		body, etag, last_updated = entry
+		unchanged = not_modified(etag, last_updated)
+		if unchanged:
+			return unchanged
+		response = make_response(body, 200, {'Content-Type': 'application/json', 'X-Cache': cached})
+		response.headers.extend(validator_headers(etag, last_updated))
+		return response
 
 
 	@api.response(404, 'show ID was not in database')
 	@api.response(200, 'Show successfully deleted')
 	@api.doc(description="Delete specified show ID from database")
 	def delete(self, id):
-		if TVshow_table.query.filter_by(id=id).first():
+		row = TVshow_table.query.filter_by(id=id).first()
+		if row:
+			affected = with_neighbours([id]) # their cached links point at this show
+			update_show_tables([(id, show_snapshot(row), None)])
 			TVshow_table.query.filter_by(id=id).delete()
 			db.session.commit() # Commit the deletetion
+			invalidate_rows(affected)
 			return {"message" : f"The tv show with id {id} was removed from the database!", "id" : id}, 200
 		return {"message" : f"ID {id} is not present in the database"}, 404
 
@@ -470,45 +2108,204 @@ class TVshow(Resource):
 		TVshow_args.parse_args()
 		row = TVshow_table.query.filter_by(id=id).first()
 		if row:
-			patch_request = request.json
-			for key in patch_request:
-
-				# Checking whether user entered keys are valid. 
-				if key not in TVshow_model.keys():
-					return {"message" : f"Invalid key {key}, please refer to table model for valid keys"}, 400
-
-				# Checking whether nested keys are valid, and if so, apply modifications to database. 
-				if key in ['schedule', 'rating', 'network']:
-					model_dict = getattr(row, key)
-					modified_dict = model_dict.copy()
-					query_dict = patch_request[key]
-					for nested_key in query_dict:
-						if nested_key not in model_dict.keys():
-							return {"message" : f"Invalid key {nested_key}, please refer to table model for valid keys"}, 400
-						if nested_key == 'country':
-							inner_modified_dict = model_dict[nested_key].copy()
-							for nested_nested_key in query_dict[nested_key]:
-								if nested_nested_key not in model_dict[nested_key].keys():
-									return {"message" : f"Invalid key {nested_nested_key}, please refer to table model for valid keys"}, 400
-								inner_modified_dict[nested_nested_key] = query_dict[nested_key][nested_nested_key]
-							modified_dict[nested_key] = inner_modified_dict
-							continue
-						modified_dict[nested_key] = query_dict[nested_key]
-					setattr(row, key, modified_dict) # change row objects column attribute to become modified_dict
-					continue	
-
-				# Special case, column type is date, user can input date like string, needs to be converted to date object
-				if key == 'premiered': 
-					setattr(row, key, datetime.strptime(patch_request[key], "%Y-%m-%d").date()) # need to convert user inputted str to date object
-					continue
+			old_snapshot = show_snapshot(row)
+			values, error = patch_values(row, request.json)
+			if error:
+				return {"message" : error}, 400
+			if 'tvmaze_id' in values: # checked before the row changes, as the query would flush it
+				owner = tvmaze_id_owners([values['tvmaze_id']]).get(values['tvmaze_id'])
+				if owner and owner[0] != id:
+					return tvmaze_id_conflict(owner)
+			for key, value in values.items():
+				setattr(row, key, value) # change row objects column attribute to the patched value
+
+			row.last_updated = next_update_time(row.last_updated) # Update when table was last updated
+			try:
+				update_show_tables([(id, old_snapshot, show_snapshot(row))])
+				db.session.commit() # Commit any changes 
+			except IntegrityError: # another request gave this tvmaze_id to a show since it was checked
+				db.session.rollback()
+				if 'tvmaze_id' not in values:
+					raise
+				return tvmaze_id_conflict(tvmaze_id_owners([values['tvmaze_id']]).get(values['tvmaze_id'], (id, row.name)))
+			invalidate_rows([id])
+			return {'message' : f"ID {id} has been patched", id : generate_response(row)}, 200
+		return {"message" : f"ID {id} is not present in the database"}, 404
 
-				setattr(row, key, patch_request[key]) # change row objects column attribute to become patch_request[key] 
 
-			row.last_updated = datetime.today().replace(microsecond=0) # Update when table was last updated
-			db.session.commit() # Commit any changes 
-			return {'message' : f"ID {id} has been patched", id : generate_response(row, update=True)}, 200
-		return {"message" : f"ID {id} is not present in the database"}, 404
+TVshow_where_model = api.model('TVshow_where', {
+	'genres': fields.List(fields.String(example="Drama"), description="Only shows having any of these genres"),
+	'language': fields.List(fields.String(example="English"), description="Only shows in any of these languages"),
+	'status': fields.List(fields.String(example="Ended"), description="Only shows with any of these statuses"),
+	'type': fields.List(fields.String(example="Scripted"), description="Only shows of any of these types"),
+	'runtime_min': fields.Integer(example=30),
+	'runtime_max': fields.Integer(example=60),
+	'premiered_after': fields.String(example="2010-01-01", description="YYYY-MM-DD"),
+	'premiered_before': fields.String(example="2019-12-31", description="YYYY-MM-DD"),
+}, strict=True) # a misspelt predicate would otherwise be dropped, widening the batch to every show
+
+TVshow_batch_patch_item_model = api.model('TVshow_batch_patch_item', {
+	'id': fields.Integer(required=True, example=1),
+	'changes': fields.Nested(TVshow_model, required=True),
+})
+
+TVshow_batch_patch_model = api.model('TVshow_batch_patch', {
+	'shows': fields.List(fields.Nested(TVshow_batch_patch_item_model), description="Each show with its own changes"),
+	'where': fields.Nested(TVshow_where_model, description="Or apply changes to every show matching these predicates"),
+	'changes': fields.Nested(TVshow_model, description="The changes for the shows matching where"),
+})
+
+TVshow_batch_delete_model = api.model('TVshow_batch_delete', {
+	'ids': fields.List(fields.Integer(example=1), description="IDs of the shows to delete"),
+	'where': fields.Nested(TVshow_where_model, description="Or delete every show matching these predicates"),
+})
+
+@api.route('/tv-shows/batch')
+class TVshow_batch(Resource):
+	@api.response(200, 'The batch was applied, see each result for its outcome')
+	@api.response(400, 'Invalid request, nothing was changed')
+	@api.doc(description="Modify many shows in a single transaction\n\n"
+						 "Send either 'shows', a list of ids with their own changes, or 'where' with the 'changes' to make to every matching show. "
+						 "Every change is checked before anything is written, IDs not in the database get a 404 result")
+	@api.expect(TVshow_batch_patch_model, validate=True)
+	def patch(self):
+		batch = request.json
+		if ('shows' in batch) == ('where' in batch or 'changes' in batch):
+			return {"message" : "Send either shows, or where together with changes"}, 400
+		if 'shows' in batch:
+			if len(batch['shows']) > current_app.config['WRITE_BATCH_LIMIT']:
+				return {"message": f"At most {current_app.config['WRITE_BATCH_LIMIT']} shows can be patched per request"}, 400
+			patches = {}
+			for item in batch['shows']:
+				if item['id'] in patches:
+					return {"message" : f"ID {item['id']} appears more than once"}, 400
+				patches[item['id']] = item['changes']
+		else:
+			if 'changes' not in batch or 'where' not in batch:
+				return {"message" : "Send either shows, or where together with changes"}, 400
+			try:
+				patches = {id : batch['changes'] for id in where_ids(batch['where'])}
+			except ValueError as error:
+				return {"message" : str(error)}, 400
+
+		errors = {id : check_patch(patch_request) for id, patch_request in patches.items()}
+		errors = {id : error for id, error in errors.items() if error}
+		outcomes = None
+		if not errors:
+			outcomes, errors = patch_shows(patches)
+		if errors:
+			return {"message" : "No shows were patched, as some changes are invalid", 
+					"errors" : [{"id" : id, "message" : error} for id, error in errors.items()]}, 400
+		return {"results" : [{"id" : id, "status" : status, "response" : response} for id, (response, status) in outcomes.items()]}, 200
+
+	@api.response(200, 'The batch was applied, see each result for its outcome')
+	@api.response(400, 'Invalid request, nothing was deleted')
+	@api.doc(description="Delete many shows in a single transaction\n\n"
+						 "Send either 'ids' or 'where', IDs not in the database get a 404 result")
+	@api.expect(TVshow_batch_delete_model, validate=True)
+	def delete(self):
+		batch = request.json
+		if ('ids' in batch) == ('where' in batch):
+			return {"message" : "Send either ids or where"}, 400
+		if 'ids' in batch:
+			if len(batch['ids']) > current_app.config['WRITE_BATCH_LIMIT']:
+				return {"message": f"At most {current_app.config['WRITE_BATCH_LIMIT']} shows can be deleted per request"}, 400
+			ids = list(dict.fromkeys(batch['ids'])) # remove duplicate ids, keeping their order
+		else:
+			try:
+				ids = where_ids(batch['where'])
+			except ValueError as error:
+				return {"message" : str(error)}, 400
+		outcomes = delete_shows(ids)
+		return {"results" : [{"id" : id, "status" : status, "response" : response} for id, (response, status) in outcomes.items()]}, 200
+
+
+@api.route('/metrics')
+@api.doc(description="Request metrics in Prometheus' text format: wall time, SQL statement count, SQL time and TVmaze time of every route, "
+					 "and the row cache's hit and miss counters")
+class Metrics(Resource):
+	@api.response(200, 'successful return of metrics')
+	def get(self):
+		lines = [line for histogram in request_histograms.values() for line in histogram.exposition()]
+		lines += current_app.extensions['row_cache'].exposition()
+		return make_response('\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+# ================================== app factory ==================================
+
+def create_app(config=None):
+	'''Builds the service: a Flask app with its database created or migrated, its TVmaze client and request metrics,
+	and the background TVmaze sync when SYNC_ENABLED. config overrides the defaults below, a few of which can also be set from the environment. Run under gunicorn with
+	gunicorn "TVshow_REST_API:create_app()"'''
+
+	app = Flask(__name__)
+	app.config['PORT'] = int(os.environ.get('TVSHOW_PORT', PORT))
+	app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('TVSHOW_DATABASE_URI', 'sqlite:///z5017350.db')
+	app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+	app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('TVSHOW_SQLITE_BUSY_TIMEOUT', 10000)) # ms a connection waits for another writer before failing
+	app.config['SQLITE_CACHE_SIZE'] = int(os.environ.get('TVSHOW_SQLITE_CACHE_SIZE', 16384)) # KiB of page cache per connection
+	app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+	app.config['CHART_CACHE_SIZE'] = 32 # rendered statistics images kept in memory
+	app.config['ROW_CACHE_SIZE'] = int(os.environ.get('TVSHOW_ROW_CACHE_SIZE', 10000)) # serialized shows kept for GET /tv-shows/<id>, 0 turns it off
+	app.config['ROW_CACHE_STORE'] = os.environ.get('TVSHOW_ROW_CACHE_STORE') # sqlite file the worker processes share the row cache in, defaults to the database's path with .row-cache appended
+	app.config['TVMAZE_WORKERS'] = 8 # concurrent TVmaze searches per batch import
+	app.config['IMPORT_BATCH_LIMIT'] = 1000
+	app.config['IMPORT_JOB_WORKERS'] = int(os.environ.get('TVSHOW_IMPORT_JOB_WORKERS', 4)) # background imports run at once, TVmaze's rate limit still applies
+	app.config['IMPORT_JOB_TIMEOUT'] = int(os.environ.get('TVSHOW_IMPORT_JOB_TIMEOUT', 600)) # seconds before a running job is taken to be dead and queued again
+	app.config['WRITE_BATCH_LIMIT'] = 10000 # shows listed in one batch patch or delete, where matches are not limited
+	app.config['EXPORT_CHUNK_SIZE'] = 1000 # rows fetched and sent at a time by the export endpoint
+	app.config['TVMAZE_BASE_URL'] = os.environ.get('TVMAZE_BASE_URL', 'http://api.tvmaze.com') # point at tvmaze_stub.py to run offline
+	app.config['TVMAZE_TIMEOUT'] = 10 # seconds
+	app.config['TVMAZE_RETRIES'] = 3
+	app.config['TVMAZE_RATE_LIMIT'] = (20, 10) # TVmaze allows 20 calls every 10 seconds, retries included
+	app.config['TVMAZE_CACHE_DIR'] = os.environ.get('TVMAZE_CACHE_DIR', os.path.join(app.root_path, 'tvmaze_cache'))
+	app.config['TVMAZE_CACHE_TTL'] = 3600 # seconds
+	app.config['SYNC_ENABLED'] = os.environ.get('TVMAZE_SYNC_ENABLED', '1') == '1' # refresh stored shows from TVmaze in the background
+	app.config['SYNC_INTERVAL'] = int(os.environ.get('TVMAZE_SYNC_INTERVAL', 3600)) # seconds
+	app.config['SYNC_WORKERS'] = 4
+	app.config['SYNC_BATCH_SIZE'] = 100 # shows per write transaction
+	app.config['SYNC_LOCK_FILE'] = os.environ.get('TVMAZE_SYNC_LOCK_FILE') # defaults to the sqlite file's path with .sync-lock appended
+	app.config['SLOW_REQUEST_SECONDS'] = float(os.environ.get('TVSHOW_SLOW_REQUEST_SECONDS', 0)) or None # dump a trace of requests slower than this
+	app.config['SLOW_REQUEST_PROFILE'] = os.environ.get('TVSHOW_SLOW_REQUEST_PROFILE', '0') == '1' # also cProfile every request, slows them down
+	app.config['SLOW_REQUEST_DIR'] = os.environ.get('TVSHOW_SLOW_REQUEST_DIR', os.path.join(app.root_path, 'slow_requests'))
+	app.config.update(config or {})
+	app.config.setdefault('BASE_URL', os.environ.get('TVSHOW_BASE_URL', f"http://127.0.0.1:{app.config['PORT']}")) # where clients reach the service, used in links
+	app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+		'poolclass': QueuePool, # Flask-SQLAlchemy would otherwise open a new sqlite connection for every session
+		'pool_size': int(os.environ.get('TVSHOW_DB_POOL_SIZE', 8)),
+		'max_overflow': int(os.environ.get('TVSHOW_DB_MAX_OVERFLOW', 16)),
+		'connect_args': {'check_same_thread': False, # pooled connections move between request threads
+						 'timeout': app.config['SQLITE_BUSY_TIMEOUT'] / 1000},
+	})
+
+	db.init_app(app)
+	api.init_app(app)
+	app.before_request(start_request_metrics)
+	app.after_request(record_request_metrics)
+	app.teardown_request(clear_request_metrics)
+	app.extensions['tvmaze'] = TVmaze_client(app.config['TVMAZE_BASE_URL'], app.config['TVMAZE_TIMEOUT'], app.config['TVMAZE_RETRIES'],
+											 app.config['TVMAZE_RATE_LIMIT'], app.config['TVMAZE_CACHE_DIR'], app.config['TVMAZE_CACHE_TTL'],
+											 pool_size=app.config['TVMAZE_WORKERS'])
+	app.extensions['chart_cache'] = Chart_cache(app.config['CHART_CACHE_SIZE'])
+	app.extensions['import_jobs'] = Import_jobs(app, app.config['IMPORT_JOB_WORKERS'], app.config['IMPORT_JOB_TIMEOUT'])
+	with app.app_context():
+		configure_sqlite(db.engine, app.config['SQLITE_BUSY_TIMEOUT'], app.config['SQLITE_CACHE_SIZE'])
+		migrate_database()
+		database_file = db.engine.url.database if db.engine.url.database not in (None, '', ':memory:') else None
+	if app.config['SYNC_LOCK_FILE'] is None and database_file:
+		app.config['SYNC_LOCK_FILE'] = database_file + '.sync-lock' # one sync per database
+	if app.config['ROW_CACHE_STORE'] is None and database_file:
+		app.config['ROW_CACHE_STORE'] = database_file + '.row-cache' # shared by every worker on the database
+	if app.config['ROW_CACHE_SIZE'] > 0 and app.config['ROW_CACHE_STORE']:
+		app.extensions['row_cache'] = Row_cache(app.config['ROW_CACHE_SIZE'], Row_store(app.config['ROW_CACHE_STORE'], app.config['ROW_CACHE_SIZE']))
+	else: # other processes can't write an in memory database, anywhere else a cache of this process alone would go stale
+		app.extensions['row_cache'] = Row_cache(app.config['ROW_CACHE_SIZE'] if database_file is None else 0)
+	app.extensions['import_jobs'].resume()
+	if app.config['SYNC_ENABLED']:
+		app.extensions['tvmaze_sync'] = start_sync(app) # None in the worker processes that lost the lock
+	return app
 
 
 if __name__ == '__main__':
-    app.run(port=PORT) # mainthread stops here
+    app = create_app()
+    app.run(port=app.config['PORT']) # mainthread stops here
@@ -0,0 +1,438 @@
+'''Reproducible benchmarks for every endpoint of TVshow_REST_API.
+
+Fills a separate database with generated shows, serves the API and a local TVmaze stub on random ports,
+then drives each endpoint with concurrent clients and reports throughput and p50/p95/p99 latency.
+
+Usage:
+	python benchmark.py run --shows 10000 --output before.json
+	python benchmark.py run --shows 10000 --output after.json
+	python benchmark.py compare before.json after.json
+
+Datasets are deterministic and kept in --data-dir, so runs on different commits measure the same data.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from datetime import datetime
+import subprocess
+import statistics
+import threading
+import argparse
+import platform
+import tempfile
+import random
+import json
+import time
+import sys
+import os
+
+import requests
+
+import TVshow_REST_API as service
+import tvmaze_stub
+
+
+# ================================== dataset ==================================
+
+def generate_dataset(app, shows, sparse, seed=0):
+	'''Fills the shows table with generated TVmaze shows. Ids are left with random gaps, like deletes leave behind'''
+
+	generator = random.Random(seed)
+	table = service.TVshow_table.__table__
+	now = datetime.now().replace(microsecond=0)
+	with app.app_context():
+		with service.db.engine.begin() as connection:
+			show_id = 0
+			batch = []
+			for tvmaze_id in range(1, shows + 1):
+				show_id += 1
+				if generator.random() < sparse / 50: # gaps average 50 ids, leaving about sparse missing ids per stored show
+					show_id += generator.randint(1, 99)
+				row = service.show_columns(tvmaze_stub.make_show(tvmaze_id))
+				row.update(id=show_id, last_updated=now if generator.random() < 0.05 else datetime(2020, 1, 1),
+						   rating_average=row['rating']['average'] if row['rating'] else None)
+				batch.append(row)
+				if len(batch) == 10000:
+					connection.execute(table.insert(), batch)
+					batch = []
+			if batch:
+				connection.execute(table.insert(), batch)
+
+			# derived tables, built the same way the migrations build them
+			service.rebuild_statistics(connection)
+			service.TVshow_genre_table.__table__.drop(connection)
+			service.add_genres_and_filter_indexes(connection)
+			service.add_search(connection)
+
+
+# ================================== load driver ==================================
+
+def percentile(latencies, fraction):
+	ordered = sorted(latencies)
+	return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def drive(base_url, make_request, requests_total, concurrency, expected):
+	'''Sends requests_total requests from concurrency clients, make_request(i) returns (method, path, json body or None).
+	Returns the throughput and latency summary of the scenario'''
+
+	latencies = []
+	errors = []
+	lock = threading.Lock()
+	local = threading.local()
+
+	def send(i):
+		if not hasattr(local, 'session'):
+			local.session = requests.Session()
+		method, path, body = make_request(i)
+		started = time.perf_counter()
+		response = local.session.request(method, base_url + path, json=body)
+		response.content # read the whole body
+		elapsed = time.perf_counter() - started
+		with lock:
+			latencies.append(elapsed)
+			if response.status_code not in expected:
+				errors.append(f'{method} {path} -> {response.status_code}')
+
+	started = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as pool:
+		list(pool.map(send, range(requests_total)))
+	duration = time.perf_counter() - started
+
+	return {
+		'requests': len(latencies),
+		'errors': len(errors),
+		'error_samples': errors[:5],
+		'duration_s': round(duration, 4),
+		'throughput_rps': round(len(latencies) / duration, 2),
+		'latency_ms': {
+			'mean': round(statistics.mean(latencies) * 1000, 3),
+			'p50': round(percentile(latencies, 0.50) * 1000, 3),
+			'p95': round(percentile(latencies, 0.95) * 1000, 3),
+			'p99': round(percentile(latencies, 0.99) * 1000, 3),
+			'max': round(max(latencies) * 1000, 3),
+		},
+	}
+
+
+def scenarios(ids, shows, args):
+	'''Returns [(name, make_request, number of requests, expected statuses)] covering every endpoint'''
+
+	generator = random.Random(1)
+	requests_total = args.requests
+	present = list(ids)
+	id_set = set(ids) # built once, the comprehensions below run over every id
+	missing = [i for i in range(1, ids[-1] + 1) if i not in id_set][:1000] or [ids[-1] + 1]
+	deletable = generator.sample(present, min(len(present) // 2, requests_total))
+	deletable_set = set(deletable)
+	patchable = [i for i in present if i not in deletable_set]
+	list_queries = {
+		'list_default': 'order_by=%2Bid&filter=id,name&page=1&page_size=100',
+		'list_rating_deep_page': f'order_by=-rating-average,%2Bname&filter=id,name,rating&page={max(1, len(ids) // 200)}&page_size=100',
+		'list_premiered_full_filter_1000': 'order_by=%2Bpremiered&filter=tvmaze_id,id,last-update,name,type,language,genres,status,'
+										   'runtime,premiered,officialSite,schedule,rating,weight,network,summary&page=2&page_size=1000',
+		'list_cursor_name': 'order_by=%2Bname&filter=id,name&cursor=start&page_size=100',
+		'list_genre_predicate': 'genres=Drama&language=English&filter=id,name&page=1&page_size=100',
+	}
+
+	plan = [('import', lambda i: ('POST', f'/tv-shows/import?name={tvmaze_stub.show_name(shows + 1 + i)}', None),
+			 min(requests_total, args.imports), {201}),
+			('import_async', lambda i: ('POST', f'/tv-shows/import?async=true&name={tvmaze_stub.show_name(shows + 1 + args.imports + i)}', None),
+			 min(requests_total, args.imports), {202})] # time to queue, the jobs finish in the background
+	for name, query in list_queries.items():
+		plan.append((name, lambda i, query=query: ('GET', f'/tv-shows?{query}', None), requests_total, {200}))
+	plan += [
+		('get_by_id_sparse', lambda i: ('GET', f'/tv-shows/{generator.choice(present)}', None), requests_total, {200}),
+		('get_by_id_missing', lambda i: ('GET', f'/tv-shows/{generator.choice(missing)}', None), requests_total, {404}),
+		('export_ndjson', lambda i: ('GET', '/tv-shows/export?format=ndjson', None), max(1, requests_total // 50), {200}),
+		('export_csv_genre', lambda i: ('GET', '/tv-shows/export?format=csv&genres=Drama&filter=id,name,genres', None), max(1, requests_total // 10), {200}),
+		('search', lambda i: ('GET', f'/tv-shows/search?q={generator.choice(tvmaze_stub.nouns)}', None), requests_total, {200}),
+		('patch', lambda i: ('PATCH', f'/tv-shows/{generator.choice(patchable)}',
+							 {'summary': f'Benchmark summary {i}', 'genres': generator.sample(tvmaze_stub.genres, 2)}), requests_total, {200}),
+	]
+	plan.append(('patch_batch_100', lambda i: ('PATCH', '/tv-shows/batch', {'shows': [{'id': id, 'changes': {'summary': f'Batch summary {i}'}}
+																				   for id in generator.sample(patchable, min(100, len(patchable)))]}),
+				 max(1, requests_total // 10), {200}))
+	for attribute in ['language', 'genres', 'status', 'type']:
+		plan.append((f'statistics_json_{attribute}', lambda i, attribute=attribute: ('GET', f'/tv-shows/statistics?format=json&by={attribute}', None),
+					 requests_total, {200}))
+		plan.append((f'statistics_image_{attribute}', lambda i, attribute=attribute: ('GET', f'/tv-shows/statistics?format=image&by={attribute}', None),
+					 max(1, requests_total // 10), {200}))
+	plan.append(('delete', lambda i: ('DELETE', f'/tv-shows/{deletable[i]}', None), len(deletable), {200}))
+	return plan
+
+
+def serve(app, port=0):
+	'''Serves app on a background thread with a threaded werkzeug server, returns (server, base url)'''
+
+	from werkzeug.serving import make_server, WSGIRequestHandler
+
+	class Quiet_handler(WSGIRequestHandler):
+		def log_request(self, *args, **kwargs):
+			pass # keep benchmark output readable
+
+	server = make_server('127.0.0.1', port, app, threaded=True, request_handler=Quiet_handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except OSError:
+		return None
+
+
+def load_app(database, tvmaze_url, cache_directory):
+	'''Builds the service against the benchmark database and stub, with TVmaze's rate limit lifted'''
+
+	return service.create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.abspath(database)}',
+							   'TVMAZE_BASE_URL': tvmaze_url,
+							   'TVMAZE_CACHE_DIR': cache_directory,
+							   'TVMAZE_RATE_LIMIT': (10 ** 6, 1), # the stub has no rate limit to respect
+							   'SYNC_ENABLED': False})
+
+
+def prepare_database(args, workspace, tvmaze_url):
+	'''Copies the dataset for args into workspace, generating it on first use, and imports the service against the copy'''
+
+	os.makedirs(args.data_dir, exist_ok=True)
+	dataset = os.path.join(args.data_dir, f'shows-{args.shows}-sparse-{args.sparse}.db')
+	database = os.path.join(workspace, 'benchmark.db')
+	if os.path.exists(dataset):
+		with open(dataset, 'rb') as source, open(database, 'wb') as target:
+			target.write(source.read()) # every run starts from the same data, even though it writes to it
+		app = load_app(database, tvmaze_url, os.path.join(workspace, 'cache'))
+	else:
+		app = load_app(database, tvmaze_url, os.path.join(workspace, 'cache'))
+		started = time.perf_counter()
+		generate_dataset(app, args.shows, args.sparse)
+		print(f"generated {args.shows} shows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+		with app.app_context():
+			service.db.engine.dispose() # closing the last connection checkpoints the WAL into the database file
+		with open(database, 'rb') as source, open(dataset, 'wb') as target:
+			target.write(source.read())
+
+	with app.app_context():
+		ids = [row[0] for row in service.db.session.query(service.TVshow_table.id).order_by(service.TVshow_table.id)]
+	return app, database, ids
+
+
+def run(args):
+	'''Runs every scenario against a copy of the dataset, returns the results json'''
+
+	workspace = tempfile.mkdtemp(prefix='tvshow-benchmark-')
+	stub, tvmaze_url = tvmaze_stub.start_stub(shows=args.shows + args.imports + 1000, latency=args.tvmaze_latency)
+	app, database, ids = prepare_database(args, workspace, tvmaze_url)
+	server, base_url = serve(app)
+
+	results = {
+		'commit': git_commit(),
+		'timestamp': datetime.now().isoformat(timespec='seconds'),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'config': {'shows': args.shows, 'sparse': args.sparse, 'requests': args.requests, 'concurrency': args.concurrency,
+				   'imports': args.imports, 'tvmaze_latency': args.tvmaze_latency},
+		'scenarios': {},
+	}
+	for name, make_request, requests_total, expected in scenarios(ids, args.shows, args):
+		if args.only and not any(name.startswith(prefix) for prefix in args.only):
+			continue
+		result = drive(base_url, make_request, requests_total, args.concurrency, expected)
+		results['scenarios'][name] = result
+		latency = result['latency_ms']
+		print(f"{name:34s} {result['throughput_rps']:9.1f} req/s  p50 {latency['p50']:8.2f}ms  p95 {latency['p95']:8.2f}ms  "
+			  f"p99 {latency['p99']:8.2f}ms  errors {result['errors']}", file=sys.stderr)
+
+	server.shutdown()
+	stub.shutdown()
+	return results
+
+
+# ================================== multi process stress ==================================
+
+def stress_worker(worker, database, tvmaze_url, ids, shows, processes, args):
+	'''Runs in its own process, like one gunicorn worker: threads reading, patching and importing shows in the shared database
+	until args.seconds pass. Returns the worker's request counts and any failed requests'''
+
+	app = load_app(database, tvmaze_url, tempfile.mkdtemp(prefix='tvshow-stress-'))
+	deadline = time.monotonic() + args.seconds
+	counts = Counter()
+	errors = []
+	lock = threading.Lock()
+	imported = iter(range(shows + 1 + worker, 10 ** 9, processes)) # every worker imports its own shows
+
+	def client_thread(seed):
+		generator = random.Random(seed)
+		client = app.test_client()
+		while time.monotonic() < deadline:
+			roll = generator.random()
+			if roll < args.writes / 2:
+				kind, response = 'patch', client.patch(f'/tv-shows/{generator.choice(ids)}',
+													   json={'summary': f'Stress summary {seed}', 'genres': generator.sample(tvmaze_stub.genres, 2)})
+			elif roll < args.writes:
+				with lock:
+					name = tvmaze_stub.show_name(next(imported))
+				kind, response = 'import', client.post(f'/tv-shows/import?name={name}')
+			elif roll < (1 + args.writes) / 2:
+				kind, response = 'get', client.get(f'/tv-shows/{generator.choice(ids)}')
+			else:
+				kind, response = 'list', client.get(generator.choice(['/tv-shows?order_by=%2Brating-average&page=3&page_size=50',
+																	  '/tv-shows/statistics?format=json&by=genres',
+																	  '/tv-shows?genres=Drama&filter=id,name&page=1']))
+			with lock:
+				counts[kind] += 1
+				if response.status_code >= 500:
+					errors.append(f"{kind} -> {response.status_code} {response.get_data(as_text=True)[:200]}")
+
+	threads = [threading.Thread(target=client_thread, args=(worker * 1000 + i,)) for i in range(args.threads)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return dict(counts), errors
+
+
+def stress(args):
+	'''Runs parallel readers and writers in several processes against one database, returns the results json.
+	Any request failing with a server error, such as database is locked, is reported as an error'''
+
+	import multiprocessing
+	workspace = tempfile.mkdtemp(prefix='tvshow-stress-')
+	stub, tvmaze_url = tvmaze_stub.start_stub(shows=args.shows + 100000) # room for every import the workers make
+	app, database, ids = prepare_database(args, workspace, tvmaze_url)
+	with app.app_context():
+		service.db.engine.dispose() # the parent holds no connections while the workers run
+
+	started = time.perf_counter()
+	with multiprocessing.get_context('spawn').Pool(args.processes) as pool: # fresh interpreters, like separate gunicorn workers
+		outcomes = pool.starmap(stress_worker, [(worker, database, tvmaze_url, ids, args.shows, args.processes, args)
+												for worker in range(args.processes)])
+	duration = time.perf_counter() - started
+	stub.shutdown()
+
+	counts = Counter()
+	errors = []
+	for worker_counts, worker_errors in outcomes:
+		counts.update(worker_counts)
+		errors.extend(worker_errors)
+	results = {
+		'commit': git_commit(),
+		'timestamp': datetime.now().isoformat(timespec='seconds'),
+		'config': {'shows': args.shows, 'processes': args.processes, 'threads': args.threads, 'seconds': args.seconds, 'writes': args.writes},
+		'requests': dict(counts),
+		'throughput_rps': round(sum(counts.values()) / duration, 2),
+		'errors': len(errors),
+		'error_samples': errors[:10],
+	}
+	print(f"{sum(counts.values())} requests ({', '.join(f'{kind} {count}' for kind, count in sorted(counts.items()))}) "
+		  f"from {args.processes} processes in {duration:.1f}s, {len(errors)} errors", file=sys.stderr)
+	return results
+
+
+# ================================== startup ==================================
+
+startup_script = '''
+import time
+started = time.perf_counter()
+import sys, json
+import TVshow_REST_API as service
+imported = time.perf_counter()
+app = service.create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1], 'TVMAZE_CACHE_DIR': sys.argv[2], 'SYNC_ENABLED': False})
+created = time.perf_counter()
+status = app.test_client().get('/tv-shows?page_size=1').status_code
+responded = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'create_app_ms': (created - imported) * 1000,
+				  'first_response_ms': (responded - started) * 1000, 'status': status, 'plotting_loaded': 'matplotlib' in sys.modules}))
+'''
+
+def startup(args):
+	'''Times import to first response in fresh interpreters, like a new worker process, against an existing database.
+	Returns the results json, its within_budget says whether the median first response met args.budget_ms'''
+
+	workspace = tempfile.mkdtemp(prefix='tvshow-startup-')
+	database_uri = f"sqlite:///{os.path.join(workspace, 'startup.db')}"
+	command = [sys.executable, '-c', startup_script, database_uri, os.path.join(workspace, 'cache')]
+	directory = os.path.dirname(os.path.abspath(__file__))
+	subprocess.run(command, cwd=directory, check=True, capture_output=True) # creates the database, and warms the disk cache
+	runs = [json.loads(subprocess.run(command, cwd=directory, check=True, capture_output=True, text=True).stdout) for _ in range(args.runs)]
+
+	summary = {key: round(statistics.median(run[key] for run in runs), 1) for key in ['import_ms', 'create_app_ms', 'first_response_ms']}
+	results = {
+		'commit': git_commit(),
+		'timestamp': datetime.now().isoformat(timespec='seconds'),
+		'python': platform.python_version(),
+		'runs': args.runs,
+		'median': summary,
+		'plotting_loaded': any(run['plotting_loaded'] for run in runs),
+		'budget_ms': args.budget_ms,
+		'within_budget': summary['first_response_ms'] <= args.budget_ms,
+	}
+	print(f"import {summary['import_ms']}ms, create_app {summary['create_app_ms']}ms, first response {summary['first_response_ms']}ms "
+		  f"(budget {args.budget_ms}ms), plotting stack loaded: {results['plotting_loaded']}", file=sys.stderr)
+	return results
+
+
+def compare(before, after):
+	'''Prints the change in throughput and latency of every scenario both result files have'''
+
+	print(f"{'scenario':34s} {'req/s':>21s} {'p50 ms':>21s} {'p99 ms':>21s}")
+	for name, old in before['scenarios'].items():
+		new = after['scenarios'].get(name)
+		if new is None:
+			continue
+		columns = []
+		for old_value, new_value in [(old['throughput_rps'], new['throughput_rps']),
+									 (old['latency_ms']['p50'], new['latency_ms']['p50']),
+									 (old['latency_ms']['p99'], new['latency_ms']['p99'])]:
+			change = (new_value - old_value) / old_value * 100 if old_value else 0
+			columns.append(f"{old_value:8.1f} -> {new_value:8.1f} {change:+6.0f}%")
+		print(f"{name:34s} " + ' '.join(columns))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Benchmarks for the TV show REST API")
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	run_parser = commands.add_parser('run', help="generate (or reuse) a dataset and benchmark every endpoint")
+	run_parser.add_argument('--shows', type=int, default=10000, help="shows in the dataset, 10k to 1M")
+	run_parser.add_argument('--sparse', type=float, default=0.3, help="missing ids per stored show")
+	run_parser.add_argument('--requests', type=int, default=500, help="requests per scenario")
+	run_parser.add_argument('--concurrency', type=int, default=8, help="concurrent clients")
+	run_parser.add_argument('--imports', type=int, default=200, help="requests in the import scenario")
+	run_parser.add_argument('--tvmaze-latency', type=float, default=0.0, help="seconds the TVmaze stub adds to each response")
+	run_parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'tvshow-benchmark-data'))
+	run_parser.add_argument('--only', nargs='*', help="only run scenarios starting with these names")
+	run_parser.add_argument('--output', help="write the results json here")
+
+	stress_parser = commands.add_parser('stress', help="parallel readers and writers in several processes, fails on any server error")
+	stress_parser.add_argument('--shows', type=int, default=10000)
+	stress_parser.add_argument('--sparse', type=float, default=0.3)
+	stress_parser.add_argument('--processes', type=int, default=4)
+	stress_parser.add_argument('--threads', type=int, default=4, help="concurrent clients in each process")
+	stress_parser.add_argument('--seconds', type=float, default=10)
+	stress_parser.add_argument('--writes', type=float, default=0.3, help="fraction of requests that patch or import shows")
+	stress_parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'tvshow-benchmark-data'))
+	stress_parser.add_argument('--output', help="write the results json here")
+
+	startup_parser = commands.add_parser('startup', help="time import to first response of a fresh process, fails over the budget")
+	startup_parser.add_argument('--runs', type=int, default=5)
+	startup_parser.add_argument('--budget-ms', type=float, default=1000)
+	startup_parser.add_argument('--output', help="write the results json here")
+
+	compare_parser = commands.add_parser('compare', help="compare two results files")
+	compare_parser.add_argument('before')
+	compare_parser.add_argument('after')
+
+	args = parser.parse_args()
+	if args.command in ['run', 'stress', 'startup']:
+		results = {'run': run, 'stress': stress, 'startup': startup}[args.command](args)
+		if args.output:
+			with open(args.output, 'w') as output:
+				json.dump(results, output, indent=2)
+		else:
+			json.dump(results, sys.stdout, indent=2)
+		if args.command == 'stress' and results['errors'] or args.command == 'startup' and not results['within_budget']:
+			sys.exit(1)
+	else:
+		with open(args.before) as before, open(args.after) as after:
+			compare(json.load(before), json.load(after))
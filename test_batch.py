@@ -0,0 +1,80 @@
+'''Batch patch and delete change many shows at once, so a where that matches more than asked for must be refused. Run with python -m pytest'''
+import pytest
+
+import TVshow_REST_API as service
+import benchmark
+
+
+@pytest.fixture
+def app(tmp_path):
+	app = service.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'shows.db'}",
+							  'TVMAZE_CACHE_DIR': str(tmp_path / 'tvmaze_cache'),
+							  'SYNC_ENABLED': False})
+	benchmark.generate_dataset(app, 30, sparse=0)
+	return app
+
+
+def stored(app, **filters):
+	'''{id: row} of the stored shows matching filters'''
+
+	with app.app_context():
+		return {row.id : row for row in service.TVshow_table.query.filter_by(**filters)}
+
+
+@pytest.mark.parametrize('where', [{}, {'langauge': ['Klingon']}, {'genres': []}, {'genres': [], 'language': []}])
+def test_where_matching_every_show_is_refused(app, where):
+	client = app.test_client()
+
+	response = client.patch('/tv-shows/batch', json={'where': where, 'changes': {'summary': 'patched'}})
+	assert response.status_code == 400
+	assert not stored(app, summary='patched')
+
+	response = client.delete('/tv-shows/batch', json={'where': where})
+	assert response.status_code == 400
+	assert len(stored(app)) == 30
+
+
+def test_where_only_changes_matching_shows(app):
+	client = app.test_client()
+	english = stored(app, language='English')
+	assert 0 < len(english) < 30
+
+	response = client.patch('/tv-shows/batch', json={'where': {'language': ['English']}, 'changes': {'summary': 'patched'}})
+	assert response.status_code == 200
+	assert set(stored(app, summary='patched')) == set(english)
+
+	response = client.delete('/tv-shows/batch', json={'where': {'language': ['English']}})
+	assert response.status_code == 200
+	assert {result['id'] for result in response.json['results']} == set(english)
+	assert not stored(app, language='English')
+	assert len(stored(app)) == 30 - len(english)
+
+
+def test_patch_ids_is_all_or_nothing(app):
+	client = app.test_client()
+
+	response = client.patch('/tv-shows/batch', json={'shows': [{'id': 1, 'changes': {'summary': 'patched'}},
+															   {'id': 2, 'changes': {'premiered': 'yesterday'}}]})
+	assert response.status_code == 400
+	assert not stored(app, summary='patched')
+
+	response = client.patch('/tv-shows/batch', json={'shows': [{'id': 1, 'changes': {'summary': 'patched'}},
+															   {'id': 1000, 'changes': {'summary': 'patched'}}]})
+	assert response.status_code == 200
+	assert [(result['id'], result['status']) for result in response.json['results']] == [(1, 200), (1000, 404)]
+	assert set(stored(app, summary='patched')) == {1}
+
+
+def test_delete_ids(app):
+	response = app.test_client().delete('/tv-shows/batch', json={'ids': [3, 1000, 3]})
+	assert response.status_code == 200
+	assert [(result['id'], result['status']) for result in response.json['results']] == [(3, 200), (1000, 404)]
+	assert 3 not in stored(app)
+	assert len(stored(app)) == 29
+
+
+def test_batch_needs_one_kind_of_selection(app):
+	client = app.test_client()
+	assert client.patch('/tv-shows/batch', json={'shows': [], 'where': {'language': ['English']}, 'changes': {}}).status_code == 400
+	assert client.delete('/tv-shows/batch', json={'ids': [1], 'where': {'language': ['English']}}).status_code == 400
+	assert len(stored(app)) == 30
@@ -0,0 +1,50 @@
+'''Neighbour links must cost the same number of queries however many ids deletes have left missing. Run with python -m pytest'''
+from sqlalchemy import event
+import pytest
+
+import TVshow_REST_API as service
+import benchmark
+
+
+@pytest.fixture
+def app(tmp_path):
+	app = service.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'shows.db'}",
+							  'TVMAZE_CACHE_DIR': str(tmp_path / 'tvmaze_cache'),
+							  'SYNC_ENABLED': False,
+							  'ROW_CACHE_SIZE': 0}) # every request goes to the database
+	benchmark.generate_dataset(app, 20000, sparse=0)
+	return app
+
+
+def count_statements(app, path):
+	statements = []
+	def count(conn, cursor, statement, parameters, context, executemany):
+		statements.append(statement)
+
+	with app.app_context():
+		engine = service.db.engine
+	event.listen(engine, 'before_cursor_execute', count)
+	try:
+		response = app.test_client().get(path)
+	finally:
+		event.remove(engine, 'before_cursor_execute', count)
+	return response, statements
+
+
+def test_get_queries_stay_flat_after_deleting_id_ranges(app):
+	response, before = count_statements(app, '/tv-shows/2')
+	assert response.status_code == 200
+	assert len(before) <= 2
+
+	with app.app_context():
+		service.TVshow_table.query.filter(service.TVshow_table.id.between(3, 19000)).delete(synchronize_session=False)
+		service.db.session.commit()
+
+	response, after = count_statements(app, '/tv-shows/2')
+	assert response.status_code == 200
+	assert response.json['_links']['next']['href'].endswith('/tv-shows/19001') # the gap is skipped
+	assert len(after) == len(before)
+
+	response, after = count_statements(app, '/tv-shows/19001')
+	assert response.json['_links']['previous']['href'].endswith('/tv-shows/2')
+	assert len(after) == len(before)
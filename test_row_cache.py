@@ -0,0 +1,39 @@
+'''Worker processes on one database share the row cache, so none serves a show another has changed. Run with python -m pytest'''
+import pytest
+
+import TVshow_REST_API as service
+import benchmark
+
+
+@pytest.fixture
+def workers(tmp_path):
+	'''Two apps on one database, standing in for two worker processes'''
+
+	config = {'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'shows.db'}",
+			  'TVMAZE_CACHE_DIR': str(tmp_path / 'tvmaze_cache'),
+			  'SYNC_ENABLED': False}
+	first = service.create_app(config)
+	benchmark.generate_dataset(first, 30, sparse=0)
+	return first, service.create_app(config)
+
+
+def test_writes_reach_the_other_workers_cache(workers):
+	first, second = (app.test_client() for app in workers)
+	second.get('/tv-shows/3')
+	cached = second.get('/tv-shows/3')
+	assert cached.headers['X-Cache'] == 'HIT'
+
+	assert first.patch('/tv-shows/3', json={'name': 'Renamed'}).status_code == 200
+	assert second.get('/tv-shows/3', headers={'If-None-Match': cached.headers['ETag']}).status_code == 200
+	assert second.get('/tv-shows/3').json['name'] == 'Renamed'
+
+	assert first.delete('/tv-shows/3').status_code == 200
+	assert second.get('/tv-shows/3').status_code == 404
+
+
+def test_cache_needs_a_shared_store_for_a_database_file(tmp_path):
+	app = service.create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'shows.db'}",
+							  'TVMAZE_CACHE_DIR': str(tmp_path / 'tvmaze_cache'),
+							  'SYNC_ENABLED': False,
+							  'ROW_CACHE_STORE': ''})
+	assert app.extensions['row_cache'].size == 0
@@ -0,0 +1,172 @@
+'''Local stand-in for the TVmaze API, so the service, its benchmarks and manual testing can run offline.
+
+Serves a deterministic catalog of generated shows through the endpoints this service calls:
+/search/shows?q=, /shows/<id> and /updates/shows?since=day|week|month
+
+Usage: python tvmaze_stub.py --port 5001 --shows 10000
+then start the service with TVMAZE_BASE_URL=http://127.0.0.1:5001
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from datetime import date, timedelta
+import threading
+import argparse
+import random
+import json
+import time
+import re
+
+adjectives = ["Silent", "Broken", "Golden", "Hidden", "Last", "Dark", "Wild", "Lost", "Secret", "Little", "Northern", "Final",
+			  "Burning", "Crimson", "Frozen", "Hollow", "Iron", "Midnight", "Savage", "Twisted", "Electric", "Lonely", "Sacred", "Restless"]
+nouns = ["River", "Kingdom", "Detective", "Kitchen", "Frontier", "Island", "Witness", "Empire", "Harbor", "Doctor", "Garden", "Signal",
+		 "Academy", "Dynasty", "Ranch", "Station", "Tribe", "Verdict", "Voyage", "Hospital", "Orchard", "Circuit", "Legacy", "Outpost"]
+genres = ["Drama", "Comedy", "Thriller", "Crime", "Action", "Science-Fiction", "Romance", "Horror", "Family", "Fantasy",
+		  "Mystery", "Adventure", "Medical", "Legal", "Supernatural", "History", "Anime", "Music", "Sports", "War"]
+networks = [(1, "NBC", "United States", "US", "America/New_York"), (2, "CBS", "United States", "US", "America/New_York"),
+			(3, "ABC", "Australia", "AU", "Australia/Sydney"), (12, "BBC One", "United Kingdom", "GB", "Europe/London"),
+			(35, "Fuji TV", "Japan", "JP", "Asia/Tokyo"), (41, "ZDF", "Germany", "DE", "Europe/Berlin"), (84, "TF1", "France", "FR", "Europe/Paris")]
+languages = ["English"] * 6 + ["Japanese", "German", "French", "Spanish", "Korean"]
+days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+started = int(time.time())
+
+
+def show_name(tvmaze_id):
+	'''Unique name for every id, only using characters the import endpoint accepts'''
+
+	combinations = len(adjectives) * len(nouns)
+	index = tvmaze_id - 1
+	name = f"{adjectives[index % len(adjectives)]} {nouns[(index // len(adjectives)) % len(nouns)]}"
+	if index >= combinations:
+		name += f" {index // combinations + 1}" # sequels once every pairing is used up
+	return name
+
+
+def make_show(tvmaze_id):
+	'''Builds the TVmaze show json for tvmaze_id, the same id always gives the same show'''
+
+	generator = random.Random(tvmaze_id)
+	network = generator.choice(networks)
+	premiered = date(1990, 1, 1) + timedelta(days=generator.randrange(12000))
+	return {
+		'id': tvmaze_id,
+		'url': f'https://www.tvmaze.com/shows/{tvmaze_id}',
+		'name': show_name(tvmaze_id),
+		'type': generator.choice(["Scripted"] * 5 + ["Reality", "Animation", "Documentary", "Talk Show"]),
+		'language': generator.choice(languages),
+		'genres': generator.sample(genres, generator.choice([0, 1, 1, 2, 2, 3])),
+		'status': generator.choice(["Ended", "Ended", "Running", "To Be Determined", "In Development"]),
+		'runtime': generator.choice([None, 22, 30, 44, 60, 60, 90]),
+		'premiered': premiered.isoformat() if generator.random() > 0.05 else None,
+		'officialSite': generator.choice([None, f'https://www.example.com/shows/{tvmaze_id}']),
+		'schedule': {'time': f'{generator.randrange(17, 24):02d}:{generator.choice(["00", "30"])}',
+					 'days': sorted(generator.sample(days, generator.choice([1, 1, 1, 5])), key=days.index)},
+		'rating': {'average': generator.choice([None, round(generator.uniform(3, 9.5), 1)])},
+		'weight': generator.randrange(101),
+		'network': {'id': network[0], 'name': network[1],
+					'country': {'name': network[2], 'code': network[3], 'timezone': network[4]}},
+		'summary': f"<p>{show_name(tvmaze_id)} follows {generator.choice(['a family', 'two rivals', 'a detective', 'a crew', 'strangers'])} "
+				   f"through {generator.choice(['a small town', 'the city', 'space', 'a hospital', 'the past'])}.</p>",
+		'updated': show_updated(tvmaze_id),
+	}
+
+
+def show_updated(tvmaze_id):
+	'''Unix time the show was last updated, somewhere in the 30 days before the stub started'''
+
+	return started - random.Random(-tvmaze_id).randrange(30 * 24 * 3600)
+
+
+class TVmaze_stub_handler(BaseHTTPRequestHandler):
+	'''Answers the TVmaze endpoints from the generated catalog'''
+
+	shows = 10000
+	latency = 0.0 # seconds added to every response, to imitate a remote API
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		params = parse_qs(url.query)
+		time.sleep(self.latency)
+		if url.path == '/search/shows':
+			return self.send_json(self.search(params.get('q', [''])[0]))
+		match = re.fullmatch(r'/shows/(\d+)', url.path)
+		if match:
+			tvmaze_id = int(match.group(1))
+			if 1 <= tvmaze_id <= self.shows:
+				return self.send_json(make_show(tvmaze_id))
+			return self.send_json({'name': 'Not Found', 'status': 404}, 404)
+		if url.path == '/updates/shows':
+			return self.send_json(self.updates(params.get('since', ['day'])[0]))
+		self.send_json({'name': 'Not Found', 'status': 404}, 404)
+
+	def search(self, show_query):
+		'''Up to 10 shows whose name contains every word of show_query, best matches first'''
+
+		words = show_query.lower().replace('-', ' ').split()
+		if not words:
+			return []
+		results = []
+		# names are generated from ids, so walk the word lists instead of the whole catalog
+		for tvmaze_id in self.candidates(words):
+			name = show_name(tvmaze_id).lower()
+			if all(word in name for word in words):
+				score = len(' '.join(words)) / len(name)
+				results.append({'score': round(score, 4), 'show': make_show(tvmaze_id)})
+		results.sort(key=lambda result: -result['score'])
+		return results[:10]
+
+	def candidates(self, words):
+		combinations = len(adjectives) * len(nouns)
+		adjective_indexes = [i for i, adjective in enumerate(adjectives) if any(word in adjective.lower() for word in words)] or range(len(adjectives))
+		noun_indexes = [i for i, noun in enumerate(nouns) if any(word in noun.lower() for word in words)] or range(len(nouns))
+		for sequel in range((self.shows - 1) // combinations + 1):
+			for noun_index in noun_indexes:
+				for adjective_index in adjective_indexes:
+					tvmaze_id = sequel * combinations + noun_index * len(adjectives) + adjective_index + 1
+					if tvmaze_id <= self.shows:
+						yield tvmaze_id
+
+	def updates(self, since):
+		'''{tvmaze id: last updated unix time} for shows updated within since'''
+
+		window = {'day': 24 * 3600, 'week': 7 * 24 * 3600, 'month': 30 * 24 * 3600}.get(since, 24 * 3600)
+		updates = {}
+		for tvmaze_id in range(1, self.shows + 1):
+			updated = show_updated(tvmaze_id)
+			if updated >= started - window:
+				updates[str(tvmaze_id)] = updated
+		return updates
+
+	def send_json(self, payload, status=200):
+		body = json.dumps(payload).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass # keep benchmark output readable
+
+
+def start_stub(port=0, shows=10000, latency=0.0):
+	'''Serves the stub on a background thread, returns (server, base url), stop with server.shutdown()'''
+
+	handler = type('TVmaze_stub', (TVmaze_stub_handler,), {'shows': shows, 'latency': latency})
+	server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Local stub of the TVmaze API")
+	parser.add_argument('--port', type=int, default=5001)
+	parser.add_argument('--shows', type=int, default=10000, help="number of shows in the generated catalog")
+	parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+	args = parser.parse_args()
+	server, base_url = start_stub(args.port, args.shows, args.latency)
+	print(f"TVmaze stub serving {args.shows} shows at {base_url}")
+	try:
+		threading.Event().wait()
+	except KeyboardInterrupt:
+		server.shutdown()